@@ -37,6 +37,9 @@
         'security/ir.model.access.csv',
         # vistas
         'views/views.xml',
+        'views/notification_job_views.xml',
+        'views/attendance_run_views.xml',
+        'views/mail_templates/cancellation_module_card.xml',
         'views/mail_templates/mail_risk1.xml',
         'views/mail_templates/mail_risk2.xml',
         'views/mail_templates/notification_cancellation_teacher_task.xml',
@@ -44,6 +47,7 @@
         # datos de modelos
         'data/registered_notification_module.xml',
         'data/registered_cron_jobs.xml',
+        'data/notification_job_cron.xml',
     ],
     # only loaded in demonstration mode
     'demo': [
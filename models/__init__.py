@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
 from . import cancellation
+from . import student
 from . import subject_student_rel
+from . import subject_employee_rel
+from . import employee
+from . import attendance_watermark
+from . import attendance_run
+from . import notification_job
 from . import cron_register_jobs
 from . import notifications
\ No newline at end of file
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models, fields
+from contextlib import contextmanager
+import time
+
+# fases de la ejecución completa y de cada aula con tiempo y nº de consultas propios
+RUN_PHASES = ('prepare', 'fetch', 'unlink')
+CLASSROOM_PHASES = ('enrol', 'reconcile')
+
+class AttendanceRun(models.Model):
+  """
+  Ejecución de la comprobación de asistencia. Guarda los tiempos, el número de
+  consultas SQL y los contadores de la ejecución completa, de cada aula y los errores
+  producidos, para poder localizar qué aulas y qué fases hacen lenta una ejecución y
+  seguir su evolución en el tiempo
+  """
+  _name = 'maya_students.attendance_run'
+  _description = 'Ejecución de la comprobación de asistencia'
+  _order = 'start_date desc'
+
+  name = fields.Char(string = 'Ejecución', required = True)
+  state = fields.Selection([
+    ('running', 'En curso'),
+    ('done', 'Finalizada'),
+    ('failed', 'Con errores'),
+    ], string = 'Estado', default = 'running', required = True, readonly = True)
+
+  start_date = fields.Datetime(string = 'Inicio', default = fields.Datetime.now, readonly = True)
+  end_date = fields.Datetime(string = 'Fin', readonly = True)
+  duration = fields.Float(string = 'Duración (s)', readonly = True, group_operator = 'avg')
+
+  classroom_count = fields.Integer(string = 'Aulas', readonly = True)
+  user_count = fields.Integer(string = 'Usuarios', readonly = True)
+  risk_count = fields.Integer(string = 'En riesgo', readonly = True)
+  created_count = fields.Integer(string = 'Anulaciones creadas', readonly = True)
+  updated_count = fields.Integer(string = 'Anulaciones actualizadas', readonly = True)
+  deleted_count = fields.Integer(string = 'Anulaciones borradas', readonly = True)
+  sql_count = fields.Integer(string = 'Consultas SQL', readonly = True)
+
+  time_prepare = fields.Float(string = 'Preparación (s)', readonly = True, group_operator = 'avg')
+  time_fetch = fields.Float(string = 'Descarga de Moodle (s)', readonly = True, group_operator = 'avg')
+  time_unlink = fields.Float(string = 'Borrado de obsoletas (s)', readonly = True, group_operator = 'avg')
+  sql_prepare = fields.Integer(string = 'Consultas preparación', readonly = True)
+  sql_fetch = fields.Integer(string = 'Consultas descarga', readonly = True)
+  sql_unlink = fields.Integer(string = 'Consultas borrado', readonly = True)
+
+  classroom_ids = fields.One2many('maya_students.attendance_run_classroom', 'run_id', string = 'Aulas', readonly = True)
+  error_ids = fields.One2many('maya_students.attendance_run_error', 'run_id', string = 'Errores', readonly = True)
+  error_count = fields.Integer(string = 'Errores', compute = '_compute_error_count')
+
+  # perfiles (cProfile) de la ejecución si el parámetro 'maya_students.profile' está activo
+  profile_attachment_ids = fields.One2many('ir.attachment', 'res_id', string = 'Perfiles',
+    domain = [('res_model', '=', 'maya_students.attendance_run')], readonly = True)
+
+  @api.depends('error_ids')
+  def _compute_error_count(self):
+    for record in self:
+      record.error_count = len(record.error_ids)
+
+  @api.model
+  def _start(self, name: str):
+    """
+    Crea el registro de una nueva ejecución
+    """
+    return self.create({'name': name})
+
+  @contextmanager
+  def _phase(self, stats: dict, phase: str):
+    """
+    Mide el tiempo y las consultas SQL de una fase y los acumula en
+    stats['time_<fase>'] y stats['sql_<fase>']. No accede a la BD: stats se guarda
+    al terminar el aula (_add_classroom) o la ejecución (_finish)
+
+    :stats diccionario de valores del aula o de la ejecución
+    :phase nombre de la fase (ver RUN_PHASES y CLASSROOM_PHASES)
+    """
+    start_queries = self.env.cr.sql_log_count
+    start = time.perf_counter()
+    try:
+      yield stats
+    finally:
+      stats[f'time_{phase}'] = stats.get(f'time_{phase}', 0.0) + time.perf_counter() - start
+      stats[f'sql_{phase}'] = stats.get(f'sql_{phase}', 0) + self.env.cr.sql_log_count - start_queries
+
+  def _add_classroom(self, values: dict):
+    """
+    Guarda los datos de un aula comprobada
+    """
+    self.ensure_one()
+    return self.env['maya_students.attendance_run_classroom'].create(dict(values, run_id = self.id))
+
+  def _add_errors(self, errors: list, course_id: int = None, classroom_moodle_id: int = None):
+    """
+    Guarda los errores producidos
+
+    :errors lista de mensajes de error
+    """
+    self.ensure_one()
+    if not errors:
+      return
+
+    self.env['maya_students.attendance_run_error'].create([{
+      'run_id': self.id,
+      'course_id': course_id,
+      'classroom_moodle_id': classroom_moodle_id,
+      'message': message,
+    } for message in errors])
+
+  def _finish(self, stats: dict):
+    """
+    Cierra la ejecución con los datos de toda la ejecución y los totales de las aulas
+
+    :stats diccionario de valores de la ejecución (tiempos y consultas de sus fases,
+           consultas totales, anulaciones borradas...)
+    """
+    self.ensure_one()
+    end_date = fields.Datetime.now()
+
+    totals = self.env['maya_students.attendance_run_classroom'].read_group(
+      [('run_id', '=', self.id)],
+      ['user_count:sum', 'risk_count:sum', 'created_count:sum', 'updated_count:sum'], [])[0]
+
+    self.write(dict(stats,
+      state = 'failed' if self.error_ids else 'done',
+      end_date = end_date,
+      duration = (end_date - self.start_date).total_seconds(),
+      classroom_count = len(self.classroom_ids),
+      user_count = totals['user_count'] or 0,
+      risk_count = totals['risk_count'] or 0,
+      created_count = totals['created_count'] or 0,
+      updated_count = totals['updated_count'] or 0,
+    ))
+
+class AttendanceRunClassroom(models.Model):
+  """
+  Datos de la comprobación de un aula en un ciclo dentro de una ejecución
+  """
+  _name = 'maya_students.attendance_run_classroom'
+  _description = 'Aula de una ejecución de la comprobación de asistencia'
+  _order = 'run_id desc, time_total desc'
+
+  run_id = fields.Many2one('maya_students.attendance_run', string = 'Ejecución', required = True, ondelete = 'cascade', index = True)
+  run_date = fields.Datetime(related = 'run_id.start_date', string = 'Fecha de la ejecución', store = True)
+
+  classroom_moodle_id = fields.Integer(string = 'Id aula Moodle')
+  subject_id = fields.Many2one('maya_core.subject', string = 'Módulo', ondelete = 'set null')
+  course_id = fields.Many2one('maya_core.course', string = 'Ciclo', ondelete = 'set null')
+  state = fields.Selection([('ok', 'Correcta'), ('error', 'Con errores')], string = 'Estado', default = 'ok')
+
+  user_count = fields.Integer(string = 'Usuarios')
+  risk_count = fields.Integer(string = 'En riesgo')
+  created_count = fields.Integer(string = 'Anulaciones creadas')
+  updated_count = fields.Integer(string = 'Anulaciones actualizadas')
+  unresolved_count = fields.Integer(string = 'Usuarios sin resolver',
+                                    help = 'Usuarios en riesgo que no se han podido asociar a un estudiante. '
+                                           'Si hay alguno, no se borran las anulaciones obsoletas del módulo')
+
+  fetch_time = fields.Float(string = 'Descarga de Moodle (s)', group_operator = 'avg',
+                            help = 'Tiempo de la petición a Moodle de los usuarios del aula')
+  time_total = fields.Float(string = 'Tiempo total (s)')
+  time_enrol = fields.Float(string = 'Matriculación (s)')
+  time_reconcile = fields.Float(string = 'Anulaciones (s)')
+  sql_total = fields.Integer(string = 'Consultas SQL')
+  sql_enrol = fields.Integer(string = 'Consultas matriculación')
+  sql_reconcile = fields.Integer(string = 'Consultas anulaciones')
+
+class AttendanceRunError(models.Model):
+  """
+  Error producido en una ejecución de la comprobación de asistencia
+  """
+  _name = 'maya_students.attendance_run_error'
+  _description = 'Error de una ejecución de la comprobación de asistencia'
+
+  run_id = fields.Many2one('maya_students.attendance_run', string = 'Ejecución', required = True, ondelete = 'cascade', index = True)
+  course_id = fields.Many2one('maya_core.course', string = 'Ciclo', ondelete = 'set null')
+  classroom_moodle_id = fields.Integer(string = 'Id aula Moodle')
+  message = fields.Text(string = 'Error')
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models, fields
+
+class AttendanceWatermark(models.Model):
+  """
+  Marca de agua de la comprobación de asistencia de un aula en un ciclo.
+  Guarda cuándo se comprobó por última vez el aula y el último acceso 
+  (lastcourseaccess) de los estudiantes en riesgo para que, en modo incremental, 
+  solo se procesen los que han cambiado
+  """
+  _name = 'maya_students.attendance_watermark'
+  _description = 'Marca de agua de la comprobación de asistencia'
+
+  classroom_moodle_id = fields.Integer(string = 'Id aula Moodle', required = True, index = True)
+  subject_id = fields.Many2one('maya_core.subject', string = 'Módulo', ondelete = 'cascade')
+  course_id = fields.Many2one('maya_core.course', string = 'Ciclo', required = True, ondelete = 'cascade')
+
+  check_date = fields.Datetime(string = 'Última comprobación', 
+                               help = 'Día y hora de la última comprobación del aula')
+
+  # moodle user id -> [lastcourseaccess, id de la anulación]
+  lastaccess_map = fields.Json(string = 'Últimos accesos', 
+                               help = 'Último acceso visto de cada estudiante en riesgo y su anulación')
+
+  _sql_constraints = [(
+    'unique_classroom_course',
+    'unique(classroom_moodle_id, subject_id, course_id)',
+    'Sólo puede haber una marca de agua por aula, módulo y ciclo.'
+  )]
+
+  @api.model
+  def _get_watermark(self, classroom_moodle_id: int, subject_id: int, course_id: int):
+    """
+    Devuelve la marca de agua del aula en el ciclo (vacía si no existe)
+    """
+    return self.search([
+      ('classroom_moodle_id', '=', classroom_moodle_id),
+      ('subject_id', '=', subject_id),
+      ('course_id', '=', course_id)
+    ], limit = 1)
+  
+  @api.model
+  def _set_watermark(self, watermark, classroom_moodle_id: int, subject_id: int, course_id: int, lastaccess_map: dict):
+    """
+    Actualiza (o crea si no existe) la marca de agua del aula en el ciclo
+    """
+    values = { 
+      'check_date': fields.Datetime.now(),
+      'lastaccess_map': lastaccess_map }
+    
+    if watermark:
+      watermark.write(values)
+    else:
+      values.update({
+        'classroom_moodle_id': classroom_moodle_id,
+        'subject_id': subject_id,
+        'course_id': course_id })
+      watermark = self.create(values)
+
+    return watermark
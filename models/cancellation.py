@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
 
-from odoo import api, models, fields
+from odoo import api, models, fields, tools
 from odoo.exceptions import UserError
+from odoo.osv import expression
 import smtplib  
 import socket   
 from odoo.tools.mail import email_normalize
 from datetime import date, datetime
 from collections import defaultdict
+from contextlib import contextmanager
+from odoo.tools.lru import LRU
+from odoo.tools.sql import create_index
 import json
 import logging
+import uuid
 
 from ...maya_core.support.helper import get_mail_server
+from ..support.profiling import profiled
 
 _logger = logging.getLogger(__name__)
 
@@ -20,6 +26,18 @@ ERROR_MAP = {
     concretar a cual de ellos pertenece su matrícula.",
 }
 
+# días tras la notificación R1 en los que pasa a R2 si no hay conexión
+## TODO parametrizae
+NUM_DIAS_AVISO = 2
+
+# nº máximo de mensajes enviados por cada conexión SMTP
+DEFAULT_MAIL_BATCH_SIZE = 100
+
+# cachés de las tarjetas de módulo de los envíos en curso: token -> LRU
+_MODULE_CARD_CACHES = {}
+# nº máximo de fragmentos (tarjetas y bloques de profesorado) por envío
+DEFAULT_MODULE_CARD_CACHE_SIZE = 2000
+
 class Cancellation(models.Model):
   """
   Anulaciones de matrícula
@@ -97,9 +115,13 @@ class Cancellation(models.Model):
   classroom_moodle_id = fields.Integer(string = 'Id aula Moodle')
   classroom_link = fields.Char(string = 'Enlace al aula', compute = '_compute_link_classroom')
 
+  # almacenado para que la regla de registro de los profesores sea un simple join indexado.
+  # Se recalcula cuando cambian las relaciones módulo-profesor o los emails de los profesores
   teacher_employee_ids = fields.Many2many('maya_core.employee',
+        'maya_students_cancellation_teacher_rel', 'cancellation_id', 'employee_id',
         string='Profesorado asociado al módulo',
         compute='_compute_teacher_employees',
+        store=True,
   )
 
   # para mostrar diferentes errores en pantalla
@@ -121,6 +143,13 @@ class Cancellation(models.Model):
     'Cada relación Subject-Student sólo puede tener una anulación de matrícula.'
   )]
 
+  def init(self):
+    # índices para las transiciones por fecha del escalado de riesgo (sólo anulaciones de oficio)
+    create_index(self.env.cr, 'maya_students_cancellation_situation_notification_date_index',
+                 self._table, ['situation', 'notification_date'], where = "cancellation_type = 'OFC'")
+    create_index(self.env.cr, 'maya_students_cancellation_situation_justification_end_date_index',
+                 self._table, ['situation', 'justification_end_date'], where = "cancellation_type = 'OFC'")
+
   @api.depends('error_codes')
   def _compute_error_descriptions(self):
     for record in self:
@@ -137,16 +166,21 @@ class Cancellation(models.Model):
   def _compute_related_cancellations(self):
     """
     Obtiene las demás anulaciones del estudiante
+    Se calcula para todos los registros a la vez con una única búsqueda
     """  
+    students = self.mapped('subject_student_rel_id.student_id')
+
+    # Buscar todas las anulaciones de los estudiantes: student_id -> [ids]
+    cancellations_by_student = defaultdict(list)
+    if students:
+      for cancellation in self.search([('subject_student_rel_id.student_id', 'in', students.ids)]):
+        cancellations_by_student[cancellation.subject_student_rel_id.student_id.id].append(cancellation.id)
+
     for record in self:
       student = record.subject_student_rel_id.student_id
       if student:
-        # Buscar todas las anulaciones del mismo estudiante
-        cancellations = self.search([
-            ('subject_student_rel_id.student_id', '=', student.id),
-            ('id', '!=', record.id)
-        ])
-        record.related_cancellations_ids = cancellations
+        record.related_cancellations_ids = self.browse(
+          [c_id for c_id in cancellations_by_student[student.id] if c_id != record.id])
       else:
         record.related_cancellations_ids = False
 
@@ -158,6 +192,10 @@ class Cancellation(models.Model):
     # fecha que consideramos como "Nunca"
     never_date = date(2000, 1, 1)
 
+    # en modo incremental las anulaciones que no cambian no se escriben (su query_date
+    # es la de su último cambio): la última consulta es la de la marca de agua del aula
+    check_dates = self._classroom_check_dates()
+
     for record in self:
       record.lastaccess_date_text = ""
 
@@ -171,15 +209,38 @@ class Cancellation(models.Model):
         fecha_str = record.lastaccess_date.strftime('%d/%m/%Y %H:%M')     
         n_dias_str = "N/D" # Valor por si 'query_date' no estuviera definida
 
+        rel = record.subject_student_rel_id
+        query_date = max(filter(None, [record.query_date, check_dates.get(
+          (record.classroom_moodle_id, rel.subject_id.id, rel.course_id.id))]), default = None)
+
         # Calculamos los días SÓLO si tenemos ambas fechas
-        if record.query_date:
+        if query_date:
           # UsO .date() en ambas para calcular días completos
-          delta = record.query_date.date() - record.lastaccess_date.date()
+          delta = query_date.date() - record.lastaccess_date.date()
           n_dias = delta.days
           n_dias_str = str(n_dias)
 
         record.lastaccess_date_text = f"{fecha_str} ({n_dias_str} dias desde la última consulta)"
 
+  def _classroom_check_dates(self) -> dict:
+    """
+    Devuelve la fecha de la última comprobación de asistencia de las aulas de las 
+    anulaciones, con una única búsqueda
+
+    :return diccionario (moodle_id del aula, id del módulo, id del ciclo) -> check_date
+    """
+    moodle_ids = { record.classroom_moodle_id for record in self if record.classroom_moodle_id }
+    if not moodle_ids:
+      return {}
+
+    return {
+      (watermark.classroom_moodle_id, watermark.subject_id.id, watermark.course_id.id): watermark.check_date
+      for watermark in self.env['maya_students.attendance_watermark'].sudo().search([
+        ('classroom_moodle_id', 'in', list(moodle_ids)),
+        ('course_id', 'in', self.subject_student_rel_id.course_id.ids)
+      ])
+    }
+
   @api.depends('classroom_moodle_id')
   def _compute_link_classroom(self):
     """
@@ -216,26 +277,65 @@ class Cancellation(models.Model):
     """
     Calcula los registros maya_core.employee de los profesores
     asociados a este módulo y ciclo.
+    Los registros se agrupan por (módulo, ciclo) y cada par se resuelve una sola vez
     """
+    employees_by_key = {}   # (subject_id, course_id) -> maya_core.employee
+
     for record in self:
-      if not record.subject_student_rel_id.subject_id or not record.subject_student_rel_id.course_id:
+      subject = record.subject_student_rel_id.subject_id
+      course = record.subject_student_rel_id.course_id
+
+      if not subject or not course:
         record.teacher_employee_ids = False
         continue
-                
-      teacher_rel = self.env['maya_core.subject_employee_rel']
-        
-      teacher_rels = teacher_rel.search([
-            ('subject_id', '=', record.subject_student_rel_id.subject_id.id),
-            ('course_id', '=', record.subject_student_rel_id.course_id.id)
-      ])
-                        
-      # De las relaciones encontradas, extraigo los profesores
-      teacher_list = teacher_rels.mapped('employee_id') 
+      
+      key = (subject.id, course.id)
+      if key not in employees_by_key:
+        employees_by_key[key] = self.env['maya_core.employee'].browse(self._get_teacher_employee_ids(*key))
+
+      record.teacher_employee_ids = employees_by_key[key]
+
+  @api.model
+  def _recompute_teacher_employees(self, subject_course_pairs):
+    """
+    Invalida la caché de profesores y marca para recalcular el profesorado de las 
+    anulaciones de los pares (módulo, ciclo) indicados. Si no hay ninguno (p.e. el 
+    empleado no tiene asignaciones de profesor) no se hace nada: la caché se comparte 
+    con el resto de modelos y vaciarla sin motivo es costoso
+    """
+    pairs = { (s_id, c_id) for s_id, c_id in subject_course_pairs if s_id and c_id }
+    if not pairs:
+      return
+
+    self.env.registry.clear_cache()
     
-      # Filtro solo los que tienen email válido (deberian ser todos)
-      valid_employees = teacher_list.filtered(lambda emp: email_normalize(emp.work_email))
+    cancellations = self.sudo().search(expression.OR([
+      [('subject_student_rel_id.subject_id', '=', subject_id), ('subject_student_rel_id.course_id', '=', course_id)]
+      for subject_id, course_id in pairs
+    ]))
+
+    if cancellations:
+      self.env.add_to_compute(self._fields['teacher_employee_ids'], cancellations)
 
-      record.teacher_employee_ids = valid_employees
+  @api.model
+  @tools.ormcache('subject_id', 'course_id')
+  def _get_teacher_employee_ids(self, subject_id: int, course_id: int) -> tuple:
+    """
+    Devuelve los ids de los profesores del módulo y ciclo que tienen un email válido.
+    El resultado se guarda en caché compartida, que se invalida cuando cambian las 
+    relaciones módulo-profesor (maya_core.subject_employee_rel) o los emails de los 
+    empleados. Se busca como superusuario para que el resultado no dependa del usuario
+    """
+    teacher_rels = self.env['maya_core.subject_employee_rel'].sudo().search([
+          ('subject_id', '=', subject_id),
+          ('course_id', '=', course_id)
+    ])
+                        
+    # De las relaciones encontradas, extraigo los profesores
+    teacher_list = teacher_rels.mapped('employee_id') 
+    
+    # Filtro solo los que tienen email válido (deberian ser todos)
+    return tuple(teacher_list.filtered(lambda emp: email_normalize(emp.work_email)).ids)
 
   #################################
   #### ENVIO DE NOTIFICACIONES #### 
@@ -285,62 +385,130 @@ class Cancellation(models.Model):
     """
     self.ensure_one() 
 
+    return record._generate_mails_from_template(risk, mail_server, include_all_cancellations)[record.id]
+
+  def _generate_mails_from_template(self, risk, mail_server, include_all_cancellations = False):
+    """
+    Genera los valores de los mail.mail de todas las anulaciones de self. 
+    El asunto y el cuerpo se renderizan de una vez para todos los registros (una 
+    llamada a _render_field por campo) y los datos que utilizan las plantillas se 
+    cargan por adelantado.
+    No hace cambios de estado aquí.
+
+    :return diccionario id de la anulación -> valores del mail.mail
+    """
+    if not self:
+      return {}
+    
     if risk == 'r1':
       template = self.env.ref('maya_students.email_template_cancellation_risk1')
     else:
       template = self.env.ref('maya_students.email_template_cancellation_risk2')
-  
-    # emails  TO, CC y REPLY
-    email_from = f'"Notificaciones CEED" <{mail_server.smtp_user}>'
-    email_to = record.student_email_corp if email_normalize(record.student_email_corp) else ''
-    email_cc = ','.join([email for email in (record.student_email, record.student_email_support) if email_normalize(email)])
-    reply_to = record._get_teachers_reply_to_emails(include_all_cancellations)
-
-    email_values = {
-      'email_from': email_from,
-      'email_to': email_to,
-      'email_cc': email_cc,
-      'reply_to': reply_to,
-      # por si existieran contactos en res.partner, que no los busque
-      'recipient_ids': [], 
-    }
 
-    email_values['mail_server_id'] = mail_server.id
+    # cargo por adelantado todo lo que utilizan las plantillas y los emails
+    cancellations = self
+    if include_all_cancellations:
+      cancellations |= self.mapped('related_cancellations_ids')
 
-    # fuerza el compute de los profesores
-    record.teacher_employee_ids
+    cancellations.mapped('subject_student_rel_id.subject_id')
+    cancellations.mapped('subject_student_rel_id.course_id')
+    self.mapped('subject_student_rel_id.student_id')
+    cancellations.mapped('teacher_employee_ids.work_email')
 
-    if include_all_cancellations:
-      for rel in record.related_cancellations_ids:
-        rel.teacher_employee_ids  
-
-    # Ponemos en contexto si queremos incluir todas las anulaciones del estudiante
-    tmpl = template.with_context(include_all_cancellations = include_all_cancellations)
-
-    # renderizo los elementos del template que son dionamicos 
-    # (pongo el subject por si lo es en un futuro)
-    # el resto de campos (CC, TOm, FROM...) los fijo por código, no están en plantilla
-    subject_rendered = tmpl._render_field(
-        'subject',  
-        [record.id], 
-    )
-    
-    body_rendered = tmpl._render_field(
-        'body_html',  
-        [record.id], 
-    )
+    # las tarjetas de los módulos se reutilizan entre los mensajes de este envío
+    with self._module_card_cache() as card_cache_token:
+      # Ponemos en contexto si queremos incluir todas las anulaciones del estudiante
+      tmpl = template.with_context(include_all_cancellations = include_all_cancellations,
+                                   module_card_cache = card_cache_token)
 
-    email_data = email_values.copy()
-    
-    email_data.update({
+      # renderizo los elementos del template que son dionamicos 
+      # (pongo el subject por si lo es en un futuro)
+      # el resto de campos (CC, TOm, FROM...) los fijo por código, no están en plantilla
+      subject_rendered = tmpl._render_field('subject', self.ids)
+      body_rendered = tmpl._render_field('body_html', self.ids)
+
+    # emails  TO, CC y REPLY
+    email_from = f'"Notificaciones CEED" <{mail_server.smtp_user}>'
+
+    mails = {}
+    for record in self:
+      email_to = record.student_email_corp if email_normalize(record.student_email_corp) else ''
+      email_cc = ','.join([email for email in (record.student_email, record.student_email_support) if email_normalize(email)])
+      reply_to = record._get_teachers_reply_to_emails(include_all_cancellations)
+
+      mails[record.id] = {
+        'email_from': email_from,
+        'email_to': email_to,
+        'email_cc': email_cc,
+        'reply_to': reply_to,
+        # por si existieran contactos en res.partner, que no los busque
+        'recipient_ids': [], 
+        'mail_server_id': mail_server.id,
         'subject': subject_rendered.get(record.id, ''),
         'body_html': body_rendered.get(record.id, ''),
         'model': template.model,
         'res_id': record.id,
-    })
+      }
 
-    return email_data
+    return mails
   
+  @contextmanager
+  def _module_card_cache(self):
+    """
+    Abre la caché de tarjetas de módulo de un envío y devuelve su token, que se
+    pasa en el contexto (module_card_cache) al renderizar las plantillas.
+    Si ya hay una abierta en el contexto se reutiliza
+    """
+    token = self.env.context.get('module_card_cache')
+    if token in _MODULE_CARD_CACHES:
+      yield token
+      return
+    
+    size = int(self.env['ir.config_parameter'].sudo().get_param(
+      'maya_students.module_card_cache_size', DEFAULT_MODULE_CARD_CACHE_SIZE))
+    
+    token = uuid.uuid4().hex
+    _MODULE_CARD_CACHES[token] = LRU(max(1, size))
+    try:
+      yield token
+    finally:
+      _MODULE_CARD_CACHES.pop(token, None)
+
+  def render_module_card(self):
+    """
+    Devuelve el HTML de la tarjeta del módulo de la anulación que se incluye en los
+    mails de riesgo. Durante un envío (module_card_cache en el contexto) las tarjetas
+    y los bloques de profesorado iguales sólo se renderizan una vez
+    """
+    self.ensure_one()
+
+    cache = _MODULE_CARD_CACHES.get(self.env.context.get('module_card_cache'))
+    subject = self.subject_student_rel_id.subject_id
+    teachers = self.teacher_employee_ids
+
+    card_key = ('card', subject.code, subject.name, self.lastaccess_date_text, self.classroom_link, tuple(teachers.ids))
+    if cache is not None and card_key in cache:
+      return cache[card_key]
+    
+    teachers_key = ('teachers', tuple(teachers.ids))
+    if cache is not None and teachers_key in cache:
+      teachers_html = cache[teachers_key]
+    else:
+      teachers_html = self.env['ir.qweb']._render('maya_students.cancellation_module_card_teachers', {
+        'teachers': teachers,
+      })
+      if cache is not None:
+        cache[teachers_key] = teachers_html
+
+    card_html = self.env['ir.qweb']._render('maya_students.cancellation_module_card', {
+      'cancel': self,
+      'teachers_html': teachers_html,
+    })
+    if cache is not None:
+      cache[card_key] = card_html
+
+    return card_html
+
   def send_r1_notification_mail_subject(self):
     """
     Fuerza el envío de un mail de notificación al alumno por una anulación en riesgo 1 
@@ -413,67 +581,230 @@ class Cancellation(models.Model):
       _logger.error(f"Error inesperado al enviar email a {self.student_name}: {str(e)}")
       raise UserError(f"Ocurrió un error inesperado al enviar el correo: {str(e)}")
 
+  @profiled()
   def send_notification_mail_subject_agruped(self):
     """
     Prepara y envia de manera agrupada por NIA los mensajes de 
     notificación de las anulaciones de oficio
+
+    Si está activo el parámetro 'maya_students.notification_queue' los mensajes no se
+    envían aquí: las anulaciones se reservan (situation '2') y los paquetes se encolan
+    para que los envíe en segundo plano el cron de maya_students.notification_job
+    """
+    # Reservo las anulaciones y preparo los paquetes
+    skipped, packages = self._reserve_notification_packages()
+
+    # Notificaciones para los profesores
+    # Anulaciones en 'Riesgo 2 Por notificar'
+    self.create_notification_items(skipped,self.env.ref('maya_students.notification_group_exofficio_cancellations').id)
+
+    if skipped:
+        _logger.info(f"Anulaciones no procesadas: {skipped}")
+
+    queue_mode = self.env['ir.config_parameter'].sudo().get_param(
+      'maya_students.notification_queue', 'False').lower() in ('1', 'true')
+
+    if queue_mode:
+      jobs = self.env['maya_students.notification_job']._enqueue(packages)
+
+      msg = (f"Mensajes en cola: {len(packages)} (en {len(jobs)} lotes). Omitidos: {len(skipped)}. "
+             f"Puede consultar el progreso en Anulaciones > Envíos en cola.")
+      return {
+          'type': 'ir.actions.client',
+          'tag': 'display_notification',
+          'params': {
+              'title': 'Notificaciones agrupadas en cola',
+              'message': msg,
+              'type': 'info',
+              'sticky': False,
+          }
+      }
+
+    result = self._deliver_notification_packages(packages)
+
+    # Finalmente mostramos notificación UI
+    msg = (f"Mensajes creados: {result['created']}. Enviados: {result['sent']}. Fallidos: {result['failed']}. "
+           f"Omitidos: {len(skipped)}. Errores generación: {len(result['generation_errors'])}.")
+    return {
+        'type': 'ir.actions.client',
+        'tag': 'display_notification',
+        'params': {
+            'title': 'Proceso de notificaciones agrupadas completado',
+            'message': msg,
+            'type': 'success' if result['failed'] == 0 and len(result['generation_errors']) == 0 else 'warning',
+            'sticky': False,
+        }
+    }
+
+  def _transition_situation(self, from_situation: str, to_situation: str, extra_values: dict = None):
+    """
+    Cambia la situación de las anulaciones con una única sentencia UPDATE protegida 
+    por la situación de partida: sólo cambian las que siguen en from_situation, por lo
+    que dos procesos concurrentes no pueden hacer la misma transición sobre una anulación
+
+    :param from_situation situación esperada
+    :param to_situation situación destino
+    :param extra_values otros campos almacenados a escribir en la misma sentencia
+
+    :return recordset con las anulaciones que han cambiado
+    """
+    if not self:
+      return self.browse()
+
+    extra_values = extra_values or {}
+    fnames = ['situation'] + list(extra_values)
+
+    self.check_access_rights('write')
+    self.check_access_rule('write')
+    # vuelco a BD las escrituras pendientes en memoria antes del UPDATE directo y marco
+    # los campos que dependen de los modificados (cachés y campos calculados almacenados)
+    self.flush_recordset(fnames)
+    self.modified(fnames)
+
+    assignments = ['"situation" = %s', '"write_uid" = %s', "\"write_date\" = (now() at time zone 'UTC')"]
+    params = [to_situation, self.env.uid]
+    for fname, value in extra_values.items():
+      assignments.append(f'"{self._fields[fname].name}" = %s')
+      params.append(value)
+
+    query = f"""
+      UPDATE "{self._table}" SET {', '.join(assignments)}
+      WHERE id = ANY(%s) AND situation = %s
+      RETURNING id
+    """
+    with self.env.cr.savepoint():
+      self.env.cr.execute(query, params + [list(self.ids), from_situation])
+      changed_ids = [row[0] for row in self.env.cr.fetchall()]
+
+    # la caché ya no refleja la BD
+    self.invalidate_recordset(fnames + ['write_uid', 'write_date'])
+
+    return self.browse(changed_ids)
+
+  def _write_access_values(self, values_by_id: dict):
     """
-    ## TODO parametrizae
-    NUM_DIAS_AVISO = 2
+    Escribe la fecha del último acceso y los códigos de error de cada anulación con
+    una única sentencia UPDATE ... FROM (VALUES ...), en lugar de un write por cada
+    combinación distinta de valores
 
+    :param values_by_id diccionario id de la anulación -> (lastaccess_date, error_codes)
+    """
+    if not values_by_id:
+      return
+
+    fnames = ['lastaccess_date', 'error_codes']
+    records = self.browse(list(values_by_id))
+
+    records.check_access_rights('write')
+    records.check_access_rule('write')
+    # vuelco a BD las escrituras pendientes en memoria antes del UPDATE directo y marco
+    # los campos que dependen de los modificados (cachés y campos calculados almacenados)
+    records.flush_recordset(fnames)
+    records.modified(fnames)
+
+    rows = ', '.join(['(%s, %s::timestamp, %s::varchar)'] * len(values_by_id))
+    params = [self.env.uid]
+    for c_id, (lastaccess_date, error_codes) in values_by_id.items():
+      params.extend([c_id, lastaccess_date, error_codes or None])
+
+    query = f"""
+      UPDATE "{self._table}" AS c
+         SET "lastaccess_date" = v.lastaccess_date, "error_codes" = v.error_codes,
+             "write_uid" = %s, "write_date" = (now() at time zone 'UTC')
+        FROM (VALUES {rows}) AS v(id, lastaccess_date, error_codes)
+       WHERE c.id = v.id
+    """
+    self.env.cr.execute(query, params)
+
+    # la caché ya no refleja la BD
+    records.invalidate_recordset(fnames + ['write_uid', 'write_date'])
+
+  def _reserve_notification_packages(self):
+    """
+    Aplica las transiciones de situación de las anulaciones seleccionadas y reserva 
+    (situation '2') las que hay que notificar, agrupadas por estudiante.
+    Las anulaciones se clasifican en una sola pasada y cada transición 
+    (7->1, 3->4 y 1->2) se aplica con una única sentencia para todo el grupo
+
+    :return tupla (skipped, packages)
+            skipped: lista de tuplas (id, motivo) de anulaciones que se saltan
+            packages: lista de dicts {'main_id': int, 'related_ids': [int,...]} con
+                      las anulaciones reservadas que se notifican en cada mensaje
+    """
     skipped = []        # lista de tuplas (id, motivo) de anulaciones que se saltan
     already_processed_in_memory = set()  # ids de cancellations ya incluidas en paquetes para ser notificadas (evita duplicados)
-    generation_errors = [] # errores de generación de correos
-
-    # Estructuras para generar mails y mapear paquetes (están pareadas).
-    mails_to_create = []   # lista de dicts con email_values
-    packages = []          # lista de dicts {'main_id': int, 'related_ids': [int,...]} para cambiar la situation si el envio ha sido correcto
+    packages = []       # lista de dicts {'main_id': int, 'related_ids': [int,...]} para cambiar la situation si el envio ha sido correcto
     
-    mail_server = get_mail_server(self, 'centro')
     today = fields.Date.today()
 
+    justification_expired_ids = []  # '7' con la justificación caducada -> '1'
+    notified_expired_ids = []       # '3' con el plazo de aviso cumplido -> '4'
+    to_notify_ids = []              # '1' -> candidatas a notificar
+
+    # Clasifico las anulaciones según la transición que les corresponde
     for record in self:
       # Ausencias justificadas
       if record.situation == '7':  
-      
         # si justificada y fecha vigente -> ignorar
         if record.justification_end_date and today <= record.justification_end_date:
           skipped.append((record.id, 'justificada_vigente'))
-          continue
         else:
-          # caducada -> pasar a '1' para procesarse en este bucle
-          try:
-            record.write({'situation': '1'})
-          except Exception as e:
-            _logger.error(f"Error escribiendo situación '1' para {record.id}: {str(e)}")
-            skipped.append((record.id, 'error_write_6->1'))
-            continue
+          # caducada -> pasar a '1' para notificarse
+          justification_expired_ids.append(record.id)
 
       # ya está notificada
       elif record.situation == '3':
         if record.notification_date:
           days = (today - record.notification_date).days
           if days >= NUM_DIAS_AVISO:
-            try:
-              record.write({'situation': '4'})  # pasa a pendiente de llamada
-              skipped.append((record.id, 'R1_notificada->R2_pendiente'))
-              continue
-            except Exception as e:
-              _logger.error(f"Error escribiendo situación '4' para {record.id}: {str(e)}")
-              skipped.append((record.id, 'error_write_3->4'))
+            notified_expired_ids.append(record.id)  # pasa a pendiente de llamada
           else:
-              skipped.append((record.id, f'notificada_reciente_{days}d'))
+            skipped.append((record.id, f'notificada_reciente_{days}d'))
         else:
           # sin fecha, por seguridad la ignorao, aunque no debería de ocurrir
           skipped.append((record.id, '3_sin_fecha'))
-          continue
+
+      # R1 sin notificar
+      elif record.situation == '1':
+        to_notify_ids.append(record.id)
 
       # Llegados a este punto, cualquier situation que no sea R1 sin notificar, no se procesa)
-      elif record.situation != '1':
+      else:
         skipped.append((record.id, f'no_envio_sit_{record.situation}'))
+
+    # 7 -> 1
+    if justification_expired_ids:
+      try:
+        changed_ids = set(self.browse(justification_expired_ids)._transition_situation('7', '1').ids)
+      except Exception as e:
+        _logger.error(f"Error escribiendo situación '1' para {justification_expired_ids}: {str(e)}")
+        changed_ids = set()
+
+      for c_id in justification_expired_ids:
+        if c_id in changed_ids:
+          to_notify_ids.append(c_id)
+        else:
+          skipped.append((c_id, 'error_write_6->1'))
+
+    # 3 -> 4
+    if notified_expired_ids:
+      try:
+        changed_ids = set(self.browse(notified_expired_ids)._transition_situation('3', '4').ids)
+      except Exception as e:
+        _logger.error(f"Error escribiendo situación '4' para {notified_expired_ids}: {str(e)}")
+        changed_ids = set()
+
+      for c_id in notified_expired_ids:
+        skipped.append((c_id, 'R1_notificada->R2_pendiente' if c_id in changed_ids else 'error_write_3->4'))
+
+    # Preparo los paquetes de las que hay que notificar (conservando el orden de selección)
+    to_notify_set = set(to_notify_ids)
+    for record in self.filtered(lambda c: c.id in to_notify_set):
+      # ya incluida como relacionada en el paquete de otra anulación
+      if record.id in already_processed_in_memory:
+        skipped.append((record.id, 'no_envio_sit_2'))
         continue
-        
-      # Sin notificación -> vamos a preparar paquete
+
       # Seleccionamos related a incluir: relacionadas que no estén ya en '2' ni en '3'
       # El resto de situaciones ya estarían contempladas
       related_to_include = record.related_cancellations_ids.filtered(lambda c: c.situation == '1' and c.id not in already_processed_in_memory)
@@ -484,60 +815,110 @@ class Cancellation(models.Model):
         skipped.append((record.id, 'sin_email'))
         continue
 
-      # Marco el registro y sus relacionados como '2' para que no 
-      # se procesen en otro proceso
-      try:
-        # el registro actual
-        record.write({'situation': '2'})
-        # marcamos related -> '2' (si los hay)
-        if related_to_include:
-          related_to_include.write({'situation': '2'})
-      except Exception as e:
-        _logger.error(f"Error poniendo en proceso de notificación la anulación (1->2) {record.id}: {str(e)}")
-        # si falla la escritura, revertimos cualquier write parcial y saltamos
-        try:
-          record.write({'situation': '1'})
-          if related_to_include:
-            related_to_include.write({'situation': '1'})
-        except Exception:
-          pass
+      # Las añado al set para no incluirlas dos veces
+      already_processed_in_memory.add(record.id)
+      already_processed_in_memory.update(related_to_include.ids)
+
+      packages.append({
+          'main_id': record.id,
+          'related_ids': related_to_include.ids,
+      })
+
+    if not packages:
+      return skipped, packages
+
+    # Marco todas las anulaciones de los paquetes como '2' para que no 
+    # se procesen en otro proceso (1 -> 2)
+    try:
+      reserved_ids = set(self.browse(list(already_processed_in_memory))._transition_situation('1', '2').ids)
+    except Exception as e:
+      _logger.error(f"Error poniendo en proceso de notificación las anulaciones (1->2): {str(e)}")
+      skipped.extend((pkg['main_id'], f'error_en_proceso_1->2:{str(e)}') for pkg in packages)
+      return skipped, []
+
+    reserved_packages = []
+    to_release_ids = []   # relacionadas reservadas de paquetes cuya principal no se ha podido reservar
 
-        skipped.append((record.id, f'error_en_proceso_1->2:{str(e)}'))
+    for pkg in packages:
+      related_ids = [r_id for r_id in pkg['related_ids'] if r_id in reserved_ids]
+
+      # otro proceso se ha adelantado con la anulación principal
+      if pkg['main_id'] not in reserved_ids:
+        to_release_ids.extend(related_ids)
+        skipped.append((pkg['main_id'], 'error_en_proceso_1->2:concurrente'))
         continue
 
-      # Las añado al set para no incluirlas dos veces
-      already_processed_in_memory.add(record.id)
-      for r in related_to_include:
-        already_processed_in_memory.add(r.id)
+      reserved_packages.append({
+          'main_id': pkg['main_id'],
+          'related_ids': related_ids,
+      })
 
-      # genero el email_values con el template (no se envía aún)
+    if to_release_ids:
       try:
-        email_values = record._generate_mail_from_template(record, mail_server, include_all_cancellations=True)
-        
-        mails_to_create.append(email_values)
-        packages.append({
-            'main_id': record.id,
-            'related_ids': related_to_include.ids,
-        })
+        self.browse(to_release_ids)._transition_situation('2', '1')
       except Exception as e:
-        _logger.error(f"Error generando mail para anulación {record.id}: {str(e)}")
-        generation_errors.append((record.id, str(e)))
+        _logger.error(f"Error revirtiendo las anulaciones {to_release_ids} a 'R1 - sin notificar': {str(e)}")
 
-        # revierto las anulaciones "en proceso" para permitir reprocesarlo luego
-        try:
-          record.write({'situation': '1'})
-          if related_to_include:
-            related_to_include.write({'situation': '1'})
-        except Exception as e2:
-            _logger.error(f"Error revirtiendo situación tras fallo generación para {record.id}: {str(e2)}")
-        continue
+    return skipped, reserved_packages
 
+  @api.model
+  def _deliver_notification_packages(self, packages, revert_failed = True):
+    """
+    Genera y envía los mensajes de los paquetes reservados (situation '2') y actualiza 
+    la situación de sus anulaciones según el resultado:
+    - enviado: '3' (R1 notificado)
+    - error generando el mensaje: '1'
+    - error en el envío: '1' si revert_failed, si no se quedan en '2' para reintentarlo
 
-    # Notificaciones para los profesores
-    # Anulaciones en 'Riesgo 2 Por notificar'
-    self.create_notification_items(skipped,self.env.ref('maya_students.notification_group_exofficio_cancellations').id)
+    :packages lista de dicts {'main_id': int, 'related_ids': [int,...]}
+    :revert_failed si False, los paquetes con error de envío no se revierten
+
+    :return diccionario con 'created', 'sent', 'failed', 'generation_errors' 
+            (lista de tuplas (id, error)) y 'failed_packages' 
+    """
+    generation_errors = [] # errores de generación de correos
+    failed_packages = []   # paquetes cuyo envío ha fallado
 
+    # Estructuras para generar mails y mapear paquetes (están pareadas).
+    mails_to_create = []   # lista de dicts con email_values
+    mail_packages = []     
+    to_revert_ids = []     # anulaciones que vuelven a '1' ('R1 - sin notificar')
 
+    mail_server = get_mail_server(self, 'centro')
+    today = fields.Date.today()
+
+    # genero el email_values con el template (no se envía aún), todos de una vez
+    # (la caché de tarjetas de módulo dura todo el envío)
+    with self._module_card_cache() as card_cache_token:
+      cached_self = self.with_context(module_card_cache = card_cache_token)
+      main_records = cached_self.browse([pkg['main_id'] for pkg in packages])
+      try:
+        generated = main_records._generate_mails_from_template('r1', mail_server, include_all_cancellations=True)
+      except Exception as e:
+        # si falla el lote, los genero uno a uno para aislar los erróneos
+        _logger.warning(f"Error generando los mails del lote de {len(packages)} paquetes, se generan de uno en uno: {str(e)}")
+        generated = {}
+
+      for pkg in packages:
+        record = cached_self.browse(pkg['main_id'])
+        try:
+          if record.id not in generated:
+            generated.update(record._generate_mails_from_template('r1', mail_server, include_all_cancellations=True))
+
+          mails_to_create.append(generated[record.id])
+          mail_packages.append(pkg)
+        except Exception as e:
+          _logger.error(f"Error generando mail para anulación {record.id}: {str(e)}")
+          generation_errors.append((record.id, str(e)))
+          # revierto las anulaciones "en proceso" para permitir reprocesarlo luego
+          to_revert_ids.extend([pkg['main_id']] + pkg.get('related_ids', []))
+          continue
+
+    if to_revert_ids:
+      try:
+        self.browse(to_revert_ids)._transition_situation('2', '1')
+      except Exception as e:
+        _logger.error(f"Error revirtiendo situación tras fallo generación para {to_revert_ids}: {str(e)}")
 
     total_created = 0 # numero de notificaciones creadas (ojo! no enviadas, que por una notificación puede haber vbarios remitentes)
     total_sent = 0
@@ -551,80 +932,130 @@ class Cancellation(models.Model):
         # fallo criticó creando mails en BD: revierto todas las reservas hechas
         _logger.error(f"Error creando registros mail.mail: {str(e)}")
         
-        for pkg in packages:
-          try:
-              self.browse([pkg['main_id']] + pkg.get('related_ids', [])).write({'situation': '1'})
-          except Exception as e2:
-              _logger.error(f"Error revirtiendo paquete {pkg}: {e2}")
+        try:
+          self.browse([c_id for pkg in mail_packages for c_id in [pkg['main_id']] + pkg.get('related_ids', [])])._transition_situation('2', '1')
+        except Exception as e2:
+          _logger.error(f"Error revirtiendo paquetes {mail_packages}: {e2}")
         raise UserError(f"Error creando los mensajes de correo: {str(e)}")
 
       total_created = len(created_mail_records)
 
-      # Envio de mail y actualizo situation en función del resultado
-      for mail_rec, pkg in zip(created_mail_records, packages):
+      # Envio de mails por lotes (una conexión SMTP por lote)
+      send_results = self._send_mails_batched(created_mail_records)
+
+      # clasifico los paquetes según el resultado del envío
+      sent_main_ids = []
+      sent_related_ids = []
+      failed_ids = []
+      failed_mail_ids = []
+
+      for mail_rec, pkg in zip(created_mail_records, mail_packages):
         main_id = pkg.get('main_id')
         related_ids = pkg.get('related_ids', [])
-        try:
-          mail_rec.send()
-          total_sent += 1
+        sent_ok, failure_reason = send_results.get(mail_rec.id, (False, 'sin resultado'))
 
-          # si ha ido bien situation -> '3'
-          try:
-            self.browse(main_id).write({
-                'situation': '3',
-                'notification_date': today
-            })
-          except Exception as e:
-            _logger.error(f"No se pudo poner la anulación {main_id} a 'R1 - notificada' tras el envío: {str(e)}")
-
-          if related_ids:
-            try:
-              self.browse(related_ids).write({'situation': '3'})
-            except Exception as e:
-              _logger.error(f"No se pudo poner ralgunas de las anulaciones relacionadas {related_ids} a 'R1 - notificada' tras envío: {str(e)}")
-
-        except (smtplib.SMTPException, socket.error) as e:
+        if sent_ok:
+          total_sent += 1
+          sent_main_ids.append(main_id)
+          sent_related_ids.extend(related_ids)
+        else:
           total_failed += 1
-          _logger.error(f"Error de Red/SMTP al enviar email a {mail_rec.id} para la anulación {main_id}: {str(e)}")
-          # Cambio la situation a '1' para permitir reintento (podrían estar en '2')
-          try:
-            self.browse([main_id] + related_ids).write({'situation': '1'})
-          except Exception as e2:
-            _logger.error(f"Error revirtiendo situación a 'R1 - sin notificar' para la anulación {main_id}: {str(e2)}")
-
+          failed_packages.append(pkg)
+          _logger.error(f"Error enviando mail id {mail_rec.id} para la anulación {main_id}: {failure_reason}")
+          failed_ids.extend([main_id] + related_ids)
+          failed_mail_ids.append(mail_rec.id)
+
+      # los mails no enviados se borran: el paquete se reintenta (o se vuelve a notificar)
+      # con un mail nuevo, y si se quedasen en la cola de correo (en error o pendientes)
+      # un reintento manual o el cron de la cola enviarían duplicados
+      if failed_mail_ids:
+        try:
+          with self.env.cr.savepoint():
+            self.env['mail.mail'].sudo().browse(failed_mail_ids).exists().unlink()
         except Exception as e:
-          total_failed += 1
-          _logger.error(f"Error inesperado enviando mail id {mail_rec.id} para la anulación {main_id}: {str(e)}")
-          try:
-            self.browse([main_id] + related_ids).write({'situation': '1'})
-          except Exception as e2:
-            _logger.error(f"Error revirtiendo situación a '1' para la anuladción {main_id}: {str(e2)}")
+          _logger.error(f"Error borrando los mails no enviados {failed_mail_ids}: {str(e)}")
 
-    # info sobre generation_errors y skipped
+      # actualizo situation en función del resultado
+      # si ha ido bien situation -> '3'
+      try:
+        self.browse(sent_main_ids)._transition_situation('2', '3', {'notification_date': today})
+      except Exception as e:
+        _logger.error(f"No se pudo poner las anulaciones {sent_main_ids} a 'R1 - notificada' tras el envío: {str(e)}")
+
+      try:
+        self.browse(sent_related_ids)._transition_situation('2', '3', {'notification_date': today})
+      except Exception as e:
+        _logger.error(f"No se pudo poner ralgunas de las anulaciones relacionadas {sent_related_ids} a 'R1 - notificada' tras envío: {str(e)}")
+
+      # Cambio la situation a '1' para permitir reintento (podrían estar en '2')
+      if revert_failed:
+        try:
+          self.browse(failed_ids)._transition_situation('2', '1')
+        except Exception as e2:
+          _logger.error(f"Error revirtiendo situación a 'R1 - sin notificar' para las anulaciones {failed_ids}: {str(e2)}")
+
+    # info sobre generation_errors
     if generation_errors:
         _logger.warning(f"Errores generando correo: {generation_errors}")
-    if skipped:
-        _logger.info(f"Anulaciones no procesadas: {skipped}")
 
-    # Finalmente mostramos notificación UI
-    msg = (f"Mensajes creados: {total_created}. Enviados: {total_sent}. Fallidos: {total_failed}. "
-           f"Omitidos: {len(skipped)}. Errores generación: {len(generation_errors)}.")
     return {
-        'type': 'ir.actions.client',
-        'tag': 'display_notification',
-        'params': {
-            'title': 'Proceso de notificaciones agrupadas completado',
-            'message': msg,
-            'type': 'success' if total_failed == 0 and len(generation_errors) == 0 else 'warning',
-            'sticky': False,
-        }
+      'created': total_created,
+      'sent': total_sent,
+      'failed': total_failed,
+      'generation_errors': generation_errors,
+      'failed_packages': failed_packages,
     }
 
   @api.model
+  def _send_mails_batched(self, mails):
+    """
+    Envía los mails en lotes de como máximo 'maya_students.mail_batch_size' mensajes.
+    mail.mail.send abre una única conexión SMTP por servidor para cada lote, por lo que
+    cada conexión envía como mucho ese número de mensajes.
+
+    :mails registros mail.mail a enviar
+
+    :return diccionario mail_id -> (enviado correctamente, motivo del fallo)
+    """
+    batch_size = max(1, int(self.env['ir.config_parameter'].sudo().get_param(
+      'maya_students.mail_batch_size', DEFAULT_MAIL_BATCH_SIZE)))
+    
+    results = {}
+
+    for i in range(0, len(mails), batch_size):
+      batch = mails[i:i + batch_size]
+
+      try:
+        batch.send(raise_exception = False)
+      except (smtplib.SMTPException, socket.error) as e:
+        # error de red o del Servidor SMTP (no hay conexión, auth fallida...)
+        _logger.error(f"Error de Red/SMTP al enviar el lote de mails {batch.ids}: {str(e)}")
+        results.update({ mail_id: (False, str(e)) for mail_id in batch.ids })
+        continue
+      except Exception as e:
+        _logger.error(f"Error inesperado al enviar el lote de mails {batch.ids}: {str(e)}")
+        results.update({ mail_id: (False, str(e)) for mail_id in batch.ids })
+        continue
+
+      # los mails enviados pueden haberse borrado (auto_delete)
+      existing = batch.exists()
+      for mail in batch:
+        if mail not in existing or mail.state == 'sent':
+          results[mail.id] = (True, '')
+        else:
+          results[mail.id] = (False, mail.failure_reason or f'estado {mail.state}')
+
+    return results
+
+  @api.model
+  @profiled()
   def create_notification_items(self, skipped_list, ngroup_id):
     """
     A partir de la lista de elementos saltados en el envio de notificación a los alumnos
-    se crean las notificaciones para que los profesores hagan las llamadas
+    se crean las notificaciones para que los profesores hagan las llamadas.
+    Si el profesor ya tiene una notificación pendiente del mismo ciclo y módulo en el 
+    grupo (identificados por sus ids, ver notifications.notification_item), se le añaden
+    los casos nuevos en lugar de crear otra y se quitan los que ya no están en R2
 
     :skipped_list lista de tuplas (cancellation_id, tag_string)
     :ngroup_id id del grupo de notificaciones (maya_core.notification_group)
@@ -633,7 +1064,7 @@ class Cancellation(models.Model):
     provider_id = self.env.ref('maya_students.notification_provider').id
 
     # Filtro las anulaciones que están en situacn de R2 por llamar
-    cancellation_ids = [c_id for (c_id, tag) in skipped_list]
+    cancellation_ids = list({c_id for (c_id, tag) in skipped_list})
     cancellations = self.env['maya_students.cancellation'].search([
         ('id', 'in', cancellation_ids),
         ('situation', '=', '4')
@@ -645,49 +1076,82 @@ class Cancellation(models.Model):
     base_url = self.env['ir.config_parameter'].get_param('web.base.url').rstrip('/') + '/'
 
     # Las agrupo por profesor, ciclo y módulo
-    # (user.id, course.id, subject.id) → [cancellations...]
-    grouped = defaultdict(list)   
+    # (user.id, course.id, subject.id) → {cancellation.id, ...}
+    # (los campos de todas las anulaciones, relaciones y empleados se leen por lotes)
+    grouped = defaultdict(set)   
 
     for c in cancellations:
-      c.teacher_employee_ids # fuerzo el compute de los empleados
-      course = c.subject_student_rel_id.course_id
-      subject = c.subject_student_rel_id.subject_id
+      course_id = c.subject_student_rel_id.course_id.id
+      subject_id = c.subject_student_rel_id.subject_id.id
 
-      for teacher in c.teacher_employee_ids:
-        user = teacher.user_id
-        if not user:
-          continue
+      for user_id in c.teacher_employee_ids.user_id.ids:
+        grouped[(user_id, course_id, subject_id)].add(c.id)
+
+    if not grouped:
+      return
+
+    # nombres de ciclos y módulos, una lectura de cada
+    course_abbrs = { course['id']: course['abbr'] or '' for course in 
+                     self.env['maya_core.course'].browse({key[1] for key in grouped if key[1]}).exists().read(['abbr']) }
+    subject_names = { subject['id']: subject['name'] or '' for subject in 
+                      self.env['maya_core.subject'].browse({key[2] for key in grouped if key[2]}).exists().read(['name']) }
+
+    def url_for(c_id):
+      return f'{base_url}/web?reload=true#id={c_id}&menu_id=289&model=maya_students.cancellation&view_type=form'
+
+    # notificaciones de los mismos profesores, ciclos y módulos que siguen pendientes 
+    # (tienen algún caso pendiente de llamada). Se buscan como superusuario porque las 
+    # reglas de registro de las anulaciones no deben cambiar la agrupación
+    NotificationItem = self.env['maya_core.notification_item'].sudo()
+    existing = {}
+    for item in NotificationItem.search([
+        ('provider_id', '=', provider_id),
+        ('ngroup_id', '=', ngroup_id),
+        ('user_id', 'in', list({key[0] for key in grouped})),
+        ('cancellation_course_id', 'in', list({key[1] for key in grouped})),
+        ('cancellation_subject_id', 'in', list({key[2] for key in grouped})),
+        ('cancellation_ids.situation', '=', '4'),
+      ]):
+      existing.setdefault((item.user_id.id, item.cancellation_course_id.id, item.cancellation_subject_id.id), item)
+
+    def body_for(num_cases):
+      to = 'llamadas pendientes a estudiantes' if num_cases > 1 else 'llamada pendiente a un estudiante'
+      return f'Tienes {num_cases} {to} en riesgo 2 de abandono (R2)'
+
+    # Creo las notificaciones (o añado los casos a las que ya existen)
+    to_create = []
+    for (user_id, course_id, subject_id), cancel_ids in grouped.items():
+      item = existing.get((user_id, course_id, subject_id))
+
+      if not item:
+        to_create.append({
+            'provider_id': provider_id,
+            'user_id': user_id,
+            'ngroup_id': ngroup_id,
+            "priority": "3",
+            "summary": f'[{course_abbrs.get(course_id, "")}] - {subject_names.get(subject_id, "")}',
+            "body": body_for(len(cancel_ids)), 
+            "link_objects": [url_for(c_id) for c_id in sorted(cancel_ids)],
+            'cancellation_course_id': course_id,
+            'cancellation_subject_id': subject_id,
+            'cancellation_ids': [(6, 0, sorted(cancel_ids))],
+        })
+        continue
 
-        key = (user.id, course.id, subject.id) 
-        if c not in grouped[key]:
-          grouped[key].append(c)
-
-    # Creo las notificaciones
-    for key, cancels in grouped.items():
-      course = self.env['maya_core.course'].browse(key[1]) if key[1] else None
-      subject = self.env['maya_core.subject'].browse(key[2]) if key[2] else None
-      user_email = self.env['res.users'].browse(key[0]).email
-
-      course_abbr = course.abbr if course and course.exists() and course.abbr else ''
-      subject_name = subject.name if subject and subject.exists() and subject.name else ''
-
-      summary = f'[{course_abbr}] - {subject_name}'
-      to = 'llamadas pendientes a estudiantes' if len(cancels) > 1 else 'llamada pendiente a un estudiante'
-      body = f'Tienes {len(cancels)} {to} en riesgo 2 de abandono (R2)'
-
-      urls = [ f'{base_url}/web?reload=true#id={c.id}&menu_id=289&model=maya_students.cancellation&view_type=form'
-               for c in cancels]
-
-      self.env['maya_core.notification_item'].create({
-          'provider_id': provider_id,
-          'user_id': key[0],
-          'ngroup_id': ngroup_id,
-          "priority": "3",
-          "summary": summary,
-          "body": body, 
-          "link_objects": urls
+      # los casos de la notificación son los que siguen pendientes de llamada más los nuevos
+      pending_ids = set(item.cancellation_ids.filtered(lambda c: c.situation == '4').ids) | cancel_ids
+      if pending_ids == set(item.cancellation_ids.ids):
+        continue
+
+      item.write({
+          "body": body_for(len(pending_ids)),
+          "link_objects": [url_for(c_id) for c_id in sorted(pending_ids)],
+          'cancellation_ids': [(6, 0, sorted(pending_ids))],
       })
 
+    if to_create:
+      NotificationItem.create(to_create)
+
   def cancellation_to_r3(self):
     """
     Pasa la anulación de oficio a R3 - Dirección
@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 
-from . import cron_check_attendance_classroom
\ No newline at end of file
+from . import cron_check_attendance_classroom
+from . import cron_risk_escalation
\ No newline at end of file
@@ -1,33 +1,39 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from odoo import models, api, fields
-from odoo.exceptions import UserError
+import threading
 import logging
+import time
 
 from ....maya_core.support.maya_logger.exceptions import MayaException
 
-# Moodle
-from ....maya_core.support.maya_moodleteacher.maya_moodle_connection import MayaMoodleConnection
-from ....maya_core.support.maya_moodleteacher.maya_moodle_user import MayaMoodleUsers
-
 from ....maya_core.models.cron_register_jobs.cron_job_enrol_users import CronJobEnrolUsers
 from ....maya_core.models.student import Student
 
-from ....maya_core.support.helper import read_itaca_csv, add_error_code
+from ....maya_core.support.helper import add_error_code
+
+from ...support.itaca import read_itaca_csv_cached, get_itaca_index
+# Moodle
+from ...support.moodle_source import get_moodle_source
+from ...support.profiling import profiled, set_profile_target
 
 _logger = logging.getLogger(__name__)
 
+# número de descargas simultáneas de aulas de Moodle por defecto
+DEFAULT_MOODLE_FETCH_WORKERS = 4
+
+# directorio con los ficheros de datos de ITACA
+ITACA_DIR = '/mnt/odoo-repo/itaca/'
+
 class CronCheckAttendanceClassroom(models.TransientModel):
   _name = 'maya_students.cron_check_attendance_classroom'
 
   @api.model
+  @profiled()
   def cron_check_attendance_classroom(self, check_classrooms_id: list[tuple[int,int]], course_id: int):
 
-    # ŧODO ponerlo en configuraciones
-    set_midnight = True
-    days = 8
-
     # comprobaciones iniciales
     if check_classrooms_id == None:
       _logger.error("CRON: check_classrooms_id no definido")
@@ -35,12 +41,122 @@ class CronCheckAttendanceClassroom(models.TransientModel):
     
     print(f'\033[0;34m[INFO]\033[0m Comprobando asistencia en el ciclo {course_id}. Número de aulas: {len(check_classrooms_id)}')
 
+    run = self._start_attendance_run(f'Ciclo {course_id}')
+    if not run:
+      return
+
+    # descarga previa (en paralelo) de los usuarios de todas las aulas
+    with run['attendance_run']._phase(run['stats'], 'fetch'):
+      classrooms_users = self._prefetch_classrooms_users(
+        run['source'], run['conn'], [classroom[0] for classroom in check_classrooms_id], run['max_workers'],
+        run['fetch_times'])
+
+    errors = []
+
+    self._check_course_classrooms(check_classrooms_id, course_id, classrooms_users, run, errors)
+
+    self._finish_attendance_run(run)
+
+  @api.model
+  @profiled()
+  def cron_check_attendance_school_year(self, check_classrooms: list[tuple[int,int,int]]):
+    """
+    Comprueba la asistencia de todos los ciclos del curso escolar de una sola vez. 
+    Cada aula de Moodle se descarga una única vez aunque la compartan varios ciclos 
+    y sus usuarios se reparten después a cada uno de ellos.
+
+    :check_classrooms lista de tuplas (moodle_id del aula, id del módulo, id del ciclo)
+    """
+    # comprobaciones iniciales
+    if check_classrooms == None:
+      _logger.error("CRON: check_classrooms no definido")
+      return
+    
+    # reparto las aulas por ciclo manteniendo el orden (y sin duplicados)
+    classrooms_by_course = {}
+    for moodle_id, subject_id, course_id in dict.fromkeys(tuple(c) for c in check_classrooms):
+      classrooms_by_course.setdefault(course_id, []).append((moodle_id, subject_id))
+
+    moodle_ids = list(dict.fromkeys(c[0] for c in check_classrooms))
+
+    print(f'\033[0;34m[INFO]\033[0m Comprobando asistencia del curso escolar. Ciclos: {len(classrooms_by_course)}. Aulas: {len(moodle_ids)}')
+
+    run = self._start_attendance_run('Curso escolar')
+    if not run:
+      return
+
+    # cada aula se descarga una sola vez
+    with run['attendance_run']._phase(run['stats'], 'fetch'):
+      classrooms_users = self._prefetch_classrooms_users(
+        run['source'], run['conn'], moodle_ids, run['max_workers'], run['fetch_times'])
+
+    errors = []
+
+    for course_id, classrooms in classrooms_by_course.items():
+      print(f'\033[0;34m[INFO]\033[0m Comprobando asistencia en el ciclo {course_id}. Número de aulas: {len(classrooms)}')
+      self._check_course_classrooms(classrooms, course_id, classrooms_users, run, errors)
+
+    self._finish_attendance_run(run)
+
+  def _start_attendance_run(self, name: str) -> dict:
+    """
+    Crea el registro de la ejecución (maya_students.attendance_run) y prepara los
+    datos comunes a toda la ejecución
+
+    :name nombre de la ejecución
+
+    :return diccionario de _prepare_attendance_run con además el registro de la 
+            ejecución ('attendance_run') y sus medidas ('stats', 'sql_start', 'fetch_times'),
+            o None si no se puede realizar la comprobación
+    """
+    attendance_run = self.env['maya_students.attendance_run']._start(name)
+    # si se está perfilando, el perfil se adjunta a la ejecución
+    set_profile_target(attendance_run)
+    stats = {}
+    sql_start = self.env.cr.sql_log_count
+
+    with attendance_run._phase(stats, 'prepare'):
+      run = self._prepare_attendance_run()
+
+    if not run:
+      attendance_run._add_errors(['No se ha podido preparar la comprobación de asistencia. Más información en el log'])
+      attendance_run._finish(dict(stats, sql_count = self.env.cr.sql_log_count - sql_start))
+      return None
+
+    run.update({
+      'attendance_run': attendance_run,
+      'stats': stats,
+      'sql_start': sql_start,
+      # moodle_id -> segundos de la descarga de los usuarios del aula
+      'fetch_times': {},
+    })
+    return run
+
+  def _finish_attendance_run(self, run: dict):
+    """
+    Cierra el registro de la ejecución con sus medidas y lo confirma en la BD
+    """
+    run['attendance_run']._finish(dict(run['stats'], sql_count = self.env.cr.sql_log_count - run['sql_start']))
+    self.env.cr.commit()
+
+  def _prepare_attendance_run(self) -> dict:
+    """
+    Prepara los datos comunes a toda la ejecución: conexión con Moodle, fecha límite,
+    datos de ITACA y parámetros de configuración
+
+    :return diccionario con los datos o None si no se puede realizar la comprobación
+    """
+    # ŧODO ponerlo en configuraciones
+    set_midnight = True
+    days = 8
+
     current_sy = (self.env['maya_core.school_year'].search([('state', '=', 1)])) # curso escolar actual  
 
+    # Moodle configurado (o el origen indicado en el contexto)
+    source = get_moodle_source(self.env)
+
     try:
-      conn = MayaMoodleConnection( 
-        user = self.env['ir.config_parameter'].get_param('maya_core.moodle_user_admin'), 
-        moodle_host = self.env['ir.config_parameter'].get_param('maya_core.moodle_url')) 
+      conn = source.connect()
     except Exception as e:
       raise Exception('No es posible realizar la conexión con Moodle' + str(e))
     
@@ -51,8 +167,6 @@ class CronCheckAttendanceClassroom(models.TransientModel):
           'No se ha definido un curso actual',
           50, # critical
           comments = '''Es posible que no se haya marcado como actual ningún curso escolar''')
-    else:
-      current_school_year = current_sy[0]
 
     current_datetime = datetime.now()
     current_day = current_datetime.strftime('%d-%m-%Y %H:%M:%S')
@@ -69,17 +183,17 @@ class CronCheckAttendanceClassroom(models.TransientModel):
     itaca_filename = self.env['ir.config_parameter'].get_param('maya_core.itaca_students_data')
     if not itaca_filename:
       print(f'\033[0;31m[ERROR]\033[0m No se ha definido el nombre del fichero de datos de itaca')
-      return
-
-    csv_file = '/mnt/odoo-repo/itaca/' + itaca_filename
+      return None
 
-    errors = []
+    csv_file = ITACA_DIR + itaca_filename
 
     try:
-      df, data_stack = read_itaca_csv(csv_file)
+      # el fichero sólo se procesa una vez por versión en cada worker
+      df, data_stack = read_itaca_csv_cached(csv_file, 
+        cache_dir = self.env['ir.config_parameter'].get_param('maya_students.itaca_cache_dir') or None)
     except Exception as e:
       print(f"\033[0;31m[ERROR]\033[0m Error procesando el fichero csv: {str(e)}")
-      return
+      return None
     
     # creo un diccionario con los cursos
     course_dict = {
@@ -88,150 +202,605 @@ class CronCheckAttendanceClassroom(models.TransientModel):
       if c.code
     }
 
-    for classroom in check_classrooms_id:
-      try:
-        print('\033[0;34m[INFO]\033[0m Obteniendo usuarios del aula -> moodle_id:', classroom[0])  
-        
-        # obtención de los usuarios 
-        users = MayaMoodleUsers.from_course(conn,  classroom[0], only_students = True)
-        risk_users = []
-
-        for user in users:
-          lastcourseaccess = getattr(user, "lastcourseaccess", None)
-
-          if not lastcourseaccess or lastcourseaccess == 0:
-            access_datetime =  datetime(2000, 1, 1, 0, 0) # con datetime.min, el widget no lo mostraba correctamente
-          else:
-            access_datetime = datetime.fromtimestamp(int(lastcourseaccess))
-          
-          if access_datetime < deadline:
-            risk_users.append([user, access_datetime])
-
-        # Preparo los datos para poder eliminar las anulaciones de los alumnos que ya se han
-        # conectado
-        # Estudiantes del módulo y ciclo
-        all_rels_in_classroom = self.env['maya_core.subject_student_rel'].search([
-            ('subject_id', '=', classroom[1]),
-            ('course_id', '=', course_id)
-        ])
-
-        # Anulaciones de oficio existentes para esta aula
-        existing_cancellations_in_db = self.env['maya_students.cancellation'].search([
-            ('subject_student_rel_id', 'in', all_rels_in_classroom.ids),
-            ('cancellation_type', '=', 'OFC') 
-        ])
-        
-        # Creo un set (resta más rápido) con todos los que hay
-        existing_cancellation_ids = set(existing_cancellations_in_db.ids)
-        
-        # otro para los que estén en riesgo
-        processed_cancellation_ids = set()
+    return {
+      'source': source,
+      'conn': conn,
+      'deadline': deadline,
+      # índice NIA -> filas para que cada búsqueda de un estudiante sea O(1)
+      'itaca': (get_itaca_index(df), data_stack, course_dict),
+      # modo incremental: sólo se escriben las anulaciones que han cambiado
+      'incremental': self.env['ir.config_parameter'].get_param(
+        'maya_students.check_attendance_incremental', 'False').lower() in ('1', 'true'),
+      # nº de descargas simultáneas de aulas de Moodle
+      'max_workers': int(self.env['ir.config_parameter'].get_param(
+        'maya_students.moodle_fetch_workers', DEFAULT_MOODLE_FETCH_WORKERS)),
+      # nº de aulas que se confirman en la BD en cada commit
+      'commit_size': max(1, int(self.env['ir.config_parameter'].get_param(
+        'maya_students.check_attendance_commit_size', 1))),
+      # estudiantes ya resueltos en la ejecución (ver _enrol_students_batch)
+      'students_memo': self._new_students_memo(),
+    }
 
-        for user in risk_users:
-          try:
-            error_code = ''
-            
-            # Crea el estudiante si no existe
-            maya_user =  CronJobEnrolUsers.enrol_student(self, user[0], classroom[1], course_id, only_create=True) 
+  def _check_course_classrooms(self, classrooms: list[tuple[int, int]], course_id: int, 
+                               classrooms_users: dict, run: dict, errors: list):
+    """
+    Comprueba la asistencia en las aulas de un ciclo con los usuarios ya descargados
+    de Moodle y borra las anulaciones obsoletas
+
+    :classrooms lista de tuplas (moodle_id del aula, id del módulo)
+    :course_id id del ciclo
+    :classrooms_users diccionario moodle_id -> usuarios del aula (o excepción)
+    :run datos comunes de la ejecución (ver _prepare_attendance_run)
+    :errors lista en la que se añaden los errores
+    """
+    attendance_run = run['attendance_run']
+    pending_commit = 0
+
+    # módulos comprobados, con errores y anulaciones nuevas o que siguen en riesgo en toda la ejecución
+    checked_subject_ids = set()
+    failed_subject_ids = set()
+    run_processed_ids = set()
+
+    for classroom in classrooms:
+      errors_start = len(errors)
+      # medidas del aula (ver maya_students.attendance_run_classroom)
+      stats = {
+        'course_id': course_id,
+        'subject_id': classroom[1],
+        'classroom_moodle_id': classroom[0],
+        'fetch_time': run['fetch_times'].get(classroom[0], 0.0),
+      }
+
+      with attendance_run._phase(stats, 'total'):
+        try:
+          # obtención de los usuarios 
+          users = classrooms_users[classroom[0]]
+          if isinstance(users, Exception):
+            raise users
+
+          # si hay un error en el aula sólo se deshacen los cambios de esa aula
+          with self.env.cr.savepoint():
+            processed_cancellation_ids = self._check_classroom(classroom, course_id, users, run['deadline'],
+              run['itaca'], run['incremental'], errors, stats, run['students_memo'])
+
+          # los estudiantes resueltos en el aula ya se pueden reutilizar en las siguientes
+          self._confirm_students_memo(run['students_memo'])
+
+          # las anulaciones obsoletas (gente que sí se ha conectado) se borran al final, de una 
+          # vez para todas las aulas. Si hay usuarios en riesgo que no se han podido asociar a 
+          # un estudiante no se sabe qué anulaciones siguen en riesgo: no se borra ninguna del módulo
+          checked_subject_ids.add(classroom[1])
+          if stats.get('unresolved_count'):
+            failed_subject_ids.add(classroom[1])
+          run_processed_ids |= processed_cancellation_ids
+
+        except Exception as e:
+          _logger.error(f"Error procesando el aula moodle_id:{classroom[0]}: {str(e)}")
+          errors.append(f'Error procesando el aula moodle_id:{classroom[0]}: {str(e)}')
+          failed_subject_ids.add(classroom[1])
+          # los cambios del aula se han deshecho (también los estudiantes creados en ella)
+          run['students_memo']['pending'].clear()
+          stats.update({'state': 'error', 'created_count': 0, 'updated_count': 0})
+
+      attendance_run._add_classroom(stats)
+      attendance_run._add_errors(errors[errors_start:], course_id, classroom[0])
+
+      pending_commit += 1
+      if pending_commit >= run['commit_size']:
+        self.env.cr.commit()  ## fuerzo el commit a la base de datos cada commit_size aulas
+        pending_commit = 0
+
+    # borro las anulaciones obsoletas de todas las aulas comprobadas sin errores
+    try:
+      with attendance_run._phase(run['stats'], 'unlink'), self.env.cr.savepoint():
+        deleted_count = self._unlink_deprecated_cancellations(course_id, checked_subject_ids - failed_subject_ids, run_processed_ids)
+      run['stats']['deleted_count'] = run['stats'].get('deleted_count', 0) + deleted_count
+    except Exception as e:
+      _logger.error(f"Error borrando las anulaciones obsoletas del ciclo {course_id}: {str(e)}")
+      errors.append(f'Error borrando las anulaciones obsoletas del ciclo {course_id}')
+      attendance_run._add_errors(errors[-1:], course_id)
+
+    # confirmo las aulas pendientes y el borrado
+    self.env.cr.commit()
+
+  def _check_classroom(self, classroom: tuple[int, int], course_id: int, users: list, deadline: datetime,
+                       itaca: tuple, incremental: bool, errors: list, stats: dict = None,
+                       students_memo: dict = None) -> set:
+    """
+    Comprueba la asistencia de los estudiantes de un aula en un ciclo: matricula a los
+    que están en riesgo y crea o actualiza sus anulaciones de oficio
+
+    :classroom tupla (moodle_id del aula, id del módulo)
+    :course_id id del ciclo que se está analizando
+    :users usuarios (estudiantes) del aula en Moodle
+    :deadline fecha a partir de la cual se considera que un estudiante está en riesgo
+    :itaca tupla (itaca_index, data_stack, course_dict) con los datos de ITACA
+    :incremental si True sólo se procesan los estudiantes que han cambiado
+    :errors lista en la que se añaden los errores
+    :stats diccionario en el que se guardan las medidas del aula (ver maya_students.attendance_run)
+    :students_memo estudiantes ya resueltos en la ejecución (ver _new_students_memo)
+
+    :return set con los ids de las anulaciones nuevas, que siguen en riesgo o que no se
+            han podido comprobar (y por tanto no se deben borrar)
+    """
+    itaca_index, data_stack, course_dict = itaca
+    Watermark = self.env['maya_students.attendance_watermark']
+    AttendanceRun = self.env['maya_students.attendance_run']
+    stats = stats if stats is not None else {}
+
+    # Anulaciones de oficio existentes para esta aula (sólo hacen falta en modo incremental)
+    existing_cancellation_ids = set()
+    if incremental:
+      existing_cancellation_ids = set(self.env['maya_students.cancellation'].search([
+        ('subject_student_rel_id.subject_id', '=', classroom[1]),
+        ('subject_student_rel_id.course_id', '=', course_id),
+        ('cancellation_type', '=', 'OFC') 
+      ]).ids)
+
+    # modo incremental: último acceso visto en la ejecución anterior de cada usuario en 
+    # riesgo. moodle user id -> [lastcourseaccess, id de la anulación]
+    watermark = Watermark._get_watermark(classroom[0], classroom[1], course_id) if incremental else None
+    last_seen = (watermark.lastaccess_map or {}) if watermark else {}
+    current_seen = {}
+
+    # anulaciones que siguen igual que en la ejecución anterior
+    unchanged_cancellation_ids = set()
+
+    risk_users = []
+    risk_count = 0
+
+    for user in users:
+      lastcourseaccess = getattr(user, "lastcourseaccess", None)
+
+      if not lastcourseaccess or lastcourseaccess == 0:
+        access_datetime =  datetime(2000, 1, 1, 0, 0) # con datetime.min, el widget no lo mostraba correctamente
+      else:
+        access_datetime = datetime.fromtimestamp(int(lastcourseaccess))
+      
+      if access_datetime < deadline:
+        risk_count += 1
+        # si no se ha conectado desde la última ejecución y su anulación sigue existiendo
+        # no hay nada que hacer con él
+        moodle_user_id = str(getattr(user, 'id', ''))
+        seen = last_seen.get(moodle_user_id)
+        if seen and seen[0] == (lastcourseaccess or 0) and seen[1] in existing_cancellation_ids:
+          unchanged_cancellation_ids.add(seen[1])
+          current_seen[moodle_user_id] = seen
+          continue
+
+        risk_users.append([user, access_datetime])
+
+    stats.update({'user_count': len(users), 'risk_count': risk_count})
+
+    # matriculo de una vez a todos los estudiantes en riesgo del aula
+    with AttendanceRun._phase(stats, 'enrol'):
+      students_by_moodle_id, enrol_errors, failed_users = self._enrol_students_batch(
+        [user[0] for user in risk_users], classroom, course_id, itaca_index, data_stack, course_dict,
+        students_memo)
+    errors += enrol_errors
+
+    # estudiantes en riesgo con errores: sus anulaciones no se pueden comprobar y se conservan
+    protected_student_ids = { student_id for student_id in failed_users.values() if student_id }
+    unresolved_count = sum(1 for student_id in failed_users.values() if not student_id)
+    if unresolved_count:
+      stats['unresolved_count'] = unresolved_count
+
+    # estudiantes en riesgo ya matriculados: lista de (maya_user, fecha último acceso)
+    risk_students = []
+    # maya_user.id -> usuario de moodle
+    moodle_users = {}
+
+    for user in risk_users:
+      maya_user = students_by_moodle_id.get(getattr(user[0], 'id', None))
+      if maya_user:
+        risk_students.append((maya_user, user[1]))
+        moodle_users[maya_user.id] = user[0]
+
+    # creo/actualizo de golpe las anulaciones de oficio de los estudiantes en riesgo
+    # y obtengo las que son nuevas o siguen en riesgo
+    with AttendanceRun._phase(stats, 'reconcile'):
+      cancellation_by_student, reconcile_errors, skipped_student_ids = self._reconcile_cancellations(
+        risk_students, classroom, course_id, only_changes = incremental, stats = stats)
+    errors += reconcile_errors
+    protected_student_ids |= skipped_student_ids
+
+    processed_cancellation_ids = set(cancellation_by_student.values()) | unchanged_cancellation_ids
+
+    if protected_student_ids:
+      processed_cancellation_ids |= set(self.env['maya_students.cancellation'].search([
+        ('cancellation_type', '=', 'OFC'),
+        ('subject_student_rel_id.subject_id', '=', classroom[1]),
+        ('subject_student_rel_id.course_id', '=', course_id),
+        ('subject_student_rel_id.student_id', 'in', list(protected_student_ids))
+      ]).ids)
+
+    if incremental:
+      for student_id, cancellation_id in cancellation_by_student.items():
+        moodle_user = moodle_users[student_id]
+        current_seen[str(getattr(moodle_user, 'id', ''))] = [getattr(moodle_user, 'lastcourseaccess', None) or 0, cancellation_id]
+      
+      Watermark._set_watermark(watermark, classroom[0], classroom[1], course_id, current_seen)
+
+    return processed_cancellation_ids
+
+  def _unlink_deprecated_cancellations(self, course_id: int, subject_ids: set, processed_ids: set) -> int:
+    """
+    Borra en una sola operación las anulaciones de oficio obsoletas (el alumno sí se ha 
+    conectado) de los módulos comprobados del ciclo: las que no se han creado o 
+    actualizado en esta ejecución y no están en situación '5'. 
+    El borrado se hace con el ORM para que se invaliden las cachés.
+
+    :course_id id del ciclo
+    :subject_ids ids de los módulos cuyas aulas se han comprobado sin errores
+    :processed_ids ids de las anulaciones nuevas o que siguen en riesgo
+
+    :return número de anulaciones borradas
+    """
+    if not subject_ids:
+      return 0
+    
+    cancellations_to_delete = self.env['maya_students.cancellation'].search([
+      ('cancellation_type', '=', 'OFC'),
+      ('subject_student_rel_id.course_id', '=', course_id),
+      ('subject_student_rel_id.subject_id', 'in', list(subject_ids)),
+      ('id', 'not in', list(processed_ids)),
+      ('situation', 'not in', ['5']) # si esta justificada no se borra
+    ])
+
+    count = len(cancellations_to_delete)
+    if count:
+      cancellations_to_delete.unlink() # Borramos los registros
+      _logger.info(f"Ciclo {course_id}: {count} cancelaciones obsoletas borradas.")
+
+    return count
+
+  def _prefetch_classrooms_users(self, source, conn, classrooms_moodle_id: list[int], max_workers: int,
+                                 fetch_times: dict = None) -> dict:
+    """
+    Descarga de Moodle los estudiantes de todas las aulas antes de empezar con las 
+    comprobaciones. Las peticiones se hacen en paralelo con un máximo de max_workers 
+    hilos. En los hilos SOLO hay tráfico de red, nunca accesos a la BD: las escrituras 
+    del ORM siguen siendo secuenciales en el cursor del cron.
+
+    :source origen de los estudiantes (ver support.moodle_source). Crea una conexión por hilo
+    :conn conexión con Moodle del hilo principal (se usa si no hay paralelismo)
+    :classrooms_moodle_id ids de Moodle de las aulas
+    :max_workers número máximo de descargas simultáneas
+    :fetch_times diccionario en el que se guardan los segundos de la descarga de cada aula
+
+    :return diccionario moodle_id -> lista de usuarios, o la excepción producida
+            en la descarga de ese aula
+    """
+    # elimino duplicados manteniendo el orden
+    classrooms_moodle_id = list(dict.fromkeys(classrooms_moodle_id))
+    fetch_times = fetch_times if fetch_times is not None else {}
+
+    if max_workers <= 1 or len(classrooms_moodle_id) <= 1:
+      return { moodle_id: self._fetch_classroom_users(source, conn, moodle_id, fetch_times) for moodle_id in classrooms_moodle_id }
+
+    # cada hilo utiliza su propia conexión con Moodle
+    local = threading.local()
+
+    def fetch(moodle_id):
+      if not hasattr(local, 'conn'):
+        try:
+          local.conn = source.connect()
+        except Exception as e:
+          return e
+      return self._fetch_classroom_users(source, local.conn, moodle_id, fetch_times)
+    
+    with ThreadPoolExecutor(max_workers = min(max_workers, len(classrooms_moodle_id))) as executor:
+      return dict(zip(classrooms_moodle_id, executor.map(fetch, classrooms_moodle_id)))
+
+  @staticmethod
+  def _fetch_classroom_users(source, conn, moodle_id: int, fetch_times: dict):
+    """
+    Obtiene los estudiantes de un aula de Moodle. Si falla devuelve la excepción
+    para que sea tratada al procesar el aula.
+    Guarda el tiempo de la descarga en fetch_times[moodle_id]
+    """
+    print('\033[0;34m[INFO]\033[0m Obteniendo usuarios del aula -> moodle_id:', moodle_id)
+
+    start = time.perf_counter()
+    try:
+      return source.course_students(conn, moodle_id)
+    except Exception as e:
+      return e
+    finally:
+      fetch_times[moodle_id] = time.perf_counter() - start
+
+  @staticmethod
+  def _update_student_from_itaca(maya_user, itaca_index, data_stack, course_dict):
+    """
+    Actualiza los datos del estudiante desde ITACA pasando sólo sus filas del fichero.
+    Si sus datos no han cambiado desde la última sincronización no se hace nada
+    """
+    nia = maya_user.nia
+    row_hash = itaca_index.row_hash(nia)
+
+    if row_hash and row_hash == maya_user.itaca_row_hash:
+      return
+    
+    _, record_errors = Student.update_student_data_from_itaca(maya_user, itaca_index.rows(nia), data_stack, course_dict)
+
+    if row_hash and not record_errors:
+      maya_user.itaca_row_hash = row_hash
+
+  @staticmethod
+  def _new_students_memo() -> dict:
+    """
+    Crea la memoria de estudiantes de una ejecución. Un estudiante en riesgo en varios
+    módulos se resuelve (creación, sincronización con ITACA y ciclos en los que está 
+    matriculado) sólo en la primera aula; en las siguientes se reutiliza el resultado.
+
+    Las entradas son diccionarios {'student_id', 'nia', 'course_ids'} indexados por id
+    de usuario de Moodle ('by_moodle_id') y por NIA ('by_nia'). Las resueltas en el 
+    aula en curso quedan en 'pending' hasta que se confirma el aula, ya que si falla
+    se deshacen sus cambios
+    """
+    return {'by_moodle_id': {}, 'by_nia': {}, 'pending': []}
+
+  @staticmethod
+  def _confirm_students_memo(students_memo: dict):
+    """
+    Pasa a la memoria los estudiantes resueltos en el aula que se acaba de confirmar
+    """
+    for moodle_user_id, entry in students_memo['pending']:
+      students_memo['by_moodle_id'][moodle_user_id] = entry
+      if entry['nia']:
+        students_memo['by_nia'][entry['nia']] = entry
+
+    students_memo['pending'].clear()
+
+  def _enrol_students_batch(self, users: list, classroom: tuple[int, int], course_id: int, 
+                            itaca_index, data_stack, course_dict: dict, students_memo: dict = None):
+    """
+    Matricula en el módulo y ciclo a todos los usuarios de Moodle de un aula.
+    Los estudiantes que no existen se crean (y se actualizan desde ITACA) de uno 
+    en uno con CronJobEnrolUsers.enrol_student, ya que la correspondencia de campos
+    Moodle -> estudiante está en maya_core. Las matrículas (subject_student_rel) que 
+    faltan se crean todas con un único create.
+
+    Para evitar conflictos en aulas compartidas, sólo se matriculan los estudiantes 
+    que pertenecen al ciclo que se está analizando
+
+    :users lista de usuarios de Moodle
+    :classroom tupla (moodle_id del aula, id del módulo)
+    :course_id id del ciclo que se está analizando
+    :itaca_index, data_stack, course_dict datos de ITACA
+    :students_memo estudiantes ya resueltos en la ejecución (ver _new_students_memo)
+
+    :return tupla (diccionario moodle user id -> maya_core.student, lista de errores,
+                   diccionario moodle user id -> id del estudiante (o None si no se ha 
+                   llegado a obtener) de los usuarios con errores)
+    """
+    errors = []
+    students_by_moodle_id = {}
+    failed_users = {}
+    students_memo = students_memo if students_memo is not None else self._new_students_memo()
+
+    for user in users:
+      maya_user = None
+      moodle_user_id = getattr(user, 'id', None)
+      # datos para los mensajes de error: tras deshacer el savepoint, el estudiante 
+      # recién creado ya no existe y no se puede leer
+      user_info = getattr(user, 'username', '')
+      student_id = None
+
+      # ya resuelto en otra aula de la ejecución
+      entry = students_memo['by_moodle_id'].get(moodle_user_id)
+      if entry:
+        if course_id in entry['course_ids']:
+          students_by_moodle_id[moodle_user_id] = self.env['maya_core.student'].browse(entry['student_id'])
+        continue
 
+      try:
+        # si falla, sólo se deshacen los cambios de este usuario
+        with self.env.cr.savepoint():
+          # Crea el estudiante si no existe
+          maya_user =  CronJobEnrolUsers.enrol_student(self, user, classroom[1], course_id, only_create=True) 
+          user_info = maya_user.student_info
+          student_id = maya_user.id
+
+          # el mismo estudiante (NIA) con otro usuario de Moodle ya se ha sincronizado. 
+          # Sólo se reutiliza si es el mismo registro: si no, la entrada (sincronización
+          # y ciclos) sería la de otro estudiante
+          entry = students_memo['by_nia'].get(maya_user.nia) if maya_user.nia else None
+          if entry and entry['student_id'] != maya_user.id:
+            entry = None
+
+          if not entry:
             # actualizo sus datos desde Itaca
-            _, record_errors = Student.update_student_data_from_itaca(maya_user, df, data_stack, course_dict)
-
-            # para evitar conflictos en aulas compartidas, solo sigo si el alumnno es del
-            # ciclo que se está analizando
-            if course_id not in maya_user.courses_ids.mapped('course_id').ids:
-              continue
-            else: # lo matriculamos
-              maya_user =  CronJobEnrolUsers.enrol_student(self, user[0], classroom[1], course_id) 
-
-            # Lo añado en lista de cancelaciones de oficio
-            subject_student = self.env['maya_core.subject_student_rel']\
-              .search([
-                ('subject_id', '=', classroom[1]),('student_id', '=', maya_user.id),('course_id', '=', course_id)
-                ], limit=1)
-            
-            # lo acabo de matricular luego debería haber un alumno
-            # si no lo hay es que posiblemente el alumno esté matriculado en maya de ese 
-            # módulo en otro ciclo.
-            # Eso puede pasar si el alumno está en dos o más ciclos y comparten el aula.
-            # NO es posible definir para ese módulo, en cual de los dos ciclos está matriculado
-            if not subject_student:
-              # busco sin tener en cuenta el curso
-              subject_student = self.env['maya_core.subject_student_rel']\
-                .search([
-                  ('subject_id', '=', classroom[1]),('student_id', '=', maya_user.id)
-                ], limit=1)
-              
-              error_code = 'A01'
-            
-            existing_cancellation = self.env['maya_students.cancellation'].search([
-              ('subject_student_rel_id', '=', subject_student.id)
-            ], limit=1)
-
-            if existing_cancellation:   # YA EXISTE: actualizo las fechas
-              existing_cancellation.write(
-                { 'query_date': fields.Datetime.now(),
-                  'lastaccess_date': user[1],
-                  'classroom_moodle_id': classroom[0],
-                  'error_codes': add_error_code(error_code or '', existing_cancellation.error_codes or '') 
-                  })
-              cancellation = existing_cancellation
-            else:
-              cancellation = self.env['maya_students.cancellation'].create([
-                { 'subject_student_rel_id': subject_student.id,
-                  'cancellation_type': 'OFC',
-                  'query_date': fields.Datetime.now(),
-                  'lastaccess_date': user[1],
-                  'situation': '1',
-                  'classroom_moodle_id': classroom[0] }])
-              
-            # si es nueva o sigue en riesgo lo añado al set
-            processed_cancellation_ids.add(cancellation.id)
-          except Exception as e:
-            _logger.error(f"Error procesando el aula moodle_id:{classroom[0]}. Usuario {maya_user.student_info}. {str(e)}")
-            errors.append(f'Error procesando el aula moodle_id:{classroom[0]}. Usuario {maya_user.student_info}. {str(e)} ')
-            self.env.cr.rollback() # Deshacemos cualquier cambio de esta usuiario en este aula
-            continue 
+            self._update_student_from_itaca(maya_user, itaca_index, data_stack, course_dict)
 
-        # obtengo las obsoletas, gente que sí se ha conectado
-        deprecated_cancellation_ids = existing_cancellation_ids - processed_cancellation_ids
+            entry = {
+              'student_id': maya_user.id,
+              'nia': maya_user.nia,
+              'course_ids': set(maya_user.courses_ids.mapped('course_id').ids),
+            }
 
-        if deprecated_cancellation_ids:
-          _logger.info(f"Aula {classroom[1]}: {len(deprecated_cancellation_ids)} anulaciones obsoletas encontradas.")
-          
-          cancellations_to_delete = self.env['maya_students.cancellation'].search([
-              ('id', 'in', list(deprecated_cancellation_ids)),
-              ('situation', 'not in', ['5']) # si esta justificada no se borra
-          ])
-
-          if cancellations_to_delete:
-            count = len(cancellations_to_delete)
-            cancellations_to_delete.unlink() # Borramos los registros
-            _logger.info(f"Aula {classroom[1]}: {count} cancelaciones obsoletas borradas.")    
-
-        self.env.cr.commit()  ## fuerzo el commit a la base de datos UNA VEZ por aula
+        students_memo['pending'].append((moodle_user_id, entry))
 
+        # solo sigo si el alumnno es del ciclo que se está analizando
+        if course_id in entry['course_ids']:
+          students_by_moodle_id[moodle_user_id] = maya_user
       except Exception as e:
-        _logger.error(f"Error procesando el aula moodle_id:{classroom[0]}: {str(e)}")
-        errors.append(f'Error procesando el aula moodle_id:{classroom[0]}')
-        self.env.cr.rollback() # Deshacemos cualquier cambio de esta aula
+        _logger.error(f"Error procesando el aula moodle_id:{classroom[0]}. Usuario {user_info}. {str(e)}")
+        errors.append(f'Error procesando el aula moodle_id:{classroom[0]}. Usuario {user_info}. {str(e)} ')
+        failed_users[moodle_user_id] = student_id
         continue 
 
-    errors_filename = ''
-    if len (errors)>0:
-      date_str = datetime.now().strftime("%y%m%d%H%M")
+    if not students_by_moodle_id:
+      return students_by_moodle_id, errors, failed_users
+    
+    # matrículas que faltan, todas de una vez
+    SubjectStudentRel = self.env['maya_core.subject_student_rel']
+    student_ids = { student.id for student in students_by_moodle_id.values() }
+
+    enrolled_ids = set(SubjectStudentRel.search([
+      ('subject_id', '=', classroom[1]),
+      ('course_id', '=', course_id),
+      ('student_id', 'in', list(student_ids))
+    ]).mapped('student_id').ids)
+
+    missing_ids = student_ids - enrolled_ids
+    if missing_ids:
+      SubjectStudentRel.create([
+        { 'subject_id': classroom[1],
+          'course_id': course_id,
+          'student_id': student_id } 
+        for student_id in missing_ids])
+
+    return students_by_moodle_id, errors, failed_users
+
+  def _reconcile_cancellations(self, risk_students: list, classroom: tuple[int, int], course_id: int, only_changes: bool = False,
+                               stats: dict = None):
+    """
+    Crea o actualiza las anulaciones de oficio de los estudiantes en riesgo de un aula
+    con un número constante de consultas: una para las relaciones estudiante-módulo, 
+    otra para las anulaciones existentes, un único create, un único write de los valores
+    comunes de las existentes y un único UPDATE con los valores propios de cada una.
+    Si el create o las escrituras fallan, se repiten de una en una para que el error
+    de un estudiante no impida procesar al resto.
+
+    :risk_students lista de tuplas (maya_user, fecha del último acceso)
+    :classroom tupla (moodle_id del aula, id del módulo)
+    :course_id id del ciclo que se está analizando
+    :only_changes si True, no se escriben las anulaciones existentes cuyos datos no cambian
+    :stats diccionario en el que se guarda el número de anulaciones creadas y actualizadas
+
+    :return tupla (diccionario student_id -> id de la anulación nueva o que sigue en riesgo, 
+                   lista de errores, set con los ids de los estudiantes que no se han procesado)
+    """
+    errors = []
+    skipped_student_ids = set()
 
-      errors_filename = f"/var/log/odoo/errores_check_attendance_{date_str}.txt" 
-      try:
-        with open(errors_filename, 'w', encoding='utf-8') as f:
-          for line in errors:
-            f.write(f"{line}\n")
+    if not risk_students:
+      return {}, errors, skipped_student_ids
+    
+    moodle_id, subject_id = classroom
+    Cancellation = self.env['maya_students.cancellation']
+
+    # relaciones del módulo de todos los estudiantes, de cualquier ciclo
+    rels = self.env['maya_core.subject_student_rel'].search([
+      ('subject_id', '=', subject_id),
+      ('student_id', 'in', list({ maya_user.id for maya_user, _ in risk_students }))
+    ])
+
+    # índices en memoria (student_id, subject_id, course_id) -> rel y student_id -> rel
+    # El segundo es para cuando el alumno está matriculado de ese módulo en otro ciclo.
+    # Eso puede pasar si el alumno está en dos o más ciclos y comparten el aula.
+    # NO es posible definir para ese módulo, en cual de los dos ciclos está matriculado
+    rels_index = {}
+    rels_by_student = {}
+    for rel in rels:
+      rels_index.setdefault((rel.student_id.id, rel.subject_id.id, rel.course_id.id), rel)
+      rels_by_student.setdefault(rel.student_id.id, rel)
+
+    # anulaciones existentes de esas relaciones: rel_id -> anulación
+    cancellations_by_rel = {
+      c.subject_student_rel_id.id: c 
+      for c in Cancellation.search([('subject_student_rel_id', 'in', rels.ids)])
+    }
+
+    now = fields.Datetime.now()
+    to_create = {}             # rel_id -> valores
+    to_write = {}              # id de la anulación -> (lastaccess_date, error_codes)
+    cancellation_by_student = {}
+    created_students = {}      # rel_id -> student_id
+    written_students = {}      # id de la anulación -> student_id
+    students = { maya_user.id: maya_user for maya_user, _ in risk_students }
+
+    for maya_user, access_datetime in risk_students:
+      error_code = ''
+      subject_student = rels_index.get((maya_user.id, subject_id, course_id))
+
+      # lo acabo de matricular luego debería haber un alumno. Si no, busco sin 
+      # tener en cuenta el curso
+      if not subject_student:
+        subject_student = rels_by_student.get(maya_user.id)
+        error_code = 'A01'
+
+      if not subject_student:
+        _logger.error(f"Error procesando el aula moodle_id:{moodle_id}. Usuario {maya_user.student_info}. No está matriculado en el módulo")
+        errors.append(f'Error procesando el aula moodle_id:{moodle_id}. Usuario {maya_user.student_info}. No está matriculado en el módulo ')
+        skipped_student_ids.add(maya_user.id)
+        continue
+
+      existing_cancellation = cancellations_by_rel.get(subject_student.id)
+
+      if existing_cancellation:   # YA EXISTE: actualizo las fechas
+        error_codes = add_error_code(error_code or '', existing_cancellation.error_codes or '')
+        # si sigue en riesgo la añado
+        cancellation_by_student[maya_user.id] = existing_cancellation.id
+
+        if only_changes and \
+            existing_cancellation.lastaccess_date == access_datetime and \
+            existing_cancellation.classroom_moodle_id == moodle_id and \
+            (existing_cancellation.error_codes or '') == error_codes:
+          continue
+
+        to_write[existing_cancellation.id] = (access_datetime, error_codes)
+        written_students[existing_cancellation.id] = maya_user.id
+      else:
+        created_students[subject_student.id] = maya_user.id
+        to_create[subject_student.id] = { 
+          'subject_student_rel_id': subject_student.id,
+          'cancellation_type': 'OFC',
+          'query_date': now,
+          'lastaccess_date': access_datetime,
+          'situation': '1',
+          'classroom_moodle_id': moodle_id }
         
-        # TODO lo utilizaremos en la notificacion via mail o telegram al adminstrador
-        errors_filename = f'\r{len(errors)} error(es). Más información en: ' + errors_filename
+    def write_cancellations(values_by_id: dict):
+      # valores comunes a todas en un único write y los de cada anulación en un único UPDATE
+      Cancellation.browse(list(values_by_id)).write({ 
+        'query_date': now,
+        'classroom_moodle_id': moodle_id })
+      Cancellation._write_access_values(values_by_id)
+
+    def skip_student(student_id: int, e: Exception):
+      # el estudiante sigue en riesgo pero su anulación no se ha podido crear o actualizar
+      _logger.error(f"Error procesando el aula moodle_id:{moodle_id}. Usuario {students[student_id].student_info}. {str(e)}")
+      errors.append(f'Error procesando el aula moodle_id:{moodle_id}. Usuario {students[student_id].student_info}. {str(e)} ')
+      skipped_student_ids.add(student_id)
+      cancellation_by_student.pop(student_id, None)
+
+    updated_count = 0
+    if to_write:
+      try:
+        with self.env.cr.savepoint():
+          write_cancellations(to_write)
+        updated_count = len(to_write)
+      except Exception as e:
+        _logger.warning(f"Error actualizando las anulaciones del aula moodle_id:{moodle_id}, se reintenta de una en una: {str(e)}")
+        for c_id, values in to_write.items():
+          try:
+            with self.env.cr.savepoint():
+              write_cancellations({c_id: values})
+            updated_count += 1
+          except Exception as e:
+            skip_student(written_students[c_id], e)
+
+    created = Cancellation.browse()
+    if to_create:
+      try:
+        with self.env.cr.savepoint():
+          created = Cancellation.create(list(to_create.values()))
+      except Exception as e:
+        _logger.warning(f"Error creando las anulaciones del aula moodle_id:{moodle_id}, se reintenta de una en una: {str(e)}")
+        for rel_id, values in to_create.items():
+          try:
+            with self.env.cr.savepoint():
+              created |= Cancellation.create(values)
+          except Exception as e:
+            skip_student(created_students[rel_id], e)
+
+      for cancellation in created:
+        cancellation_by_student[created_students[cancellation.subject_student_rel_id.id]] = cancellation.id
 
-      except IOError as e:
-        raise UserError(f"Error al escribir en el fichero: {str(e)}")
+    if stats is not None:
+      stats['created_count'] = len(created)
+      stats['updated_count'] = updated_count
 
-  
-              
\ No newline at end of file
+    return cancellation_by_student, errors, skipped_student_ids
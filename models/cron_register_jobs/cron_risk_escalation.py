@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from odoo import models, api, fields
+from odoo.osv import expression
+import logging
+
+from ..cancellation import NUM_DIAS_AVISO
+
+_logger = logging.getLogger(__name__)
+
+class CronRiskEscalation(models.TransientModel):
+  _name = 'maya_students.cron_risk_escalation'
+
+  @api.model
+  def cron_risk_escalation(self, check_classrooms_id: list[tuple[int,int]] = None, course_id: int = None):
+    """
+    Aplica a todas las anulaciones de oficio las transiciones de riesgo que dependen 
+    sólo de la fecha, sin necesidad de seleccionarlas a mano:
+    - justificación caducada ('7') -> R1 sin notificar ('1')
+    - R1 notificada hace NUM_DIAS_AVISO días o más ('3') -> R2 pendiente de llamada ('4')
+    Las R1 notificadas sin fecha de notificación (las relacionadas de los envíos agrupados
+    anteriores no la guardaban) toman como fecha la de hoy, por lo que escalan a R2 
+    dentro de NUM_DIAS_AVISO días. Sólo se crean las notificaciones a los profesores de las que pasan a R2
+
+    :param check_classrooms_id no se utiliza. Se acepta para que el cron pueda 
+           registrarse con el mismo contexto que el resto de comprobaciones por ciclo
+    :param course_id si se indica, sólo se procesan las anulaciones de ese ciclo
+    """
+    Cancellation = self.env['maya_students.cancellation']
+    today = fields.Date.today()
+
+    base_domain = [('cancellation_type', '=', 'OFC')]
+    if course_id:
+      base_domain = expression.AND([base_domain, [('subject_student_rel_id.course_id', '=', course_id)]])
+
+    # 7 -> 1
+    expired_justifications = Cancellation.search(expression.AND([base_domain, [
+      ('situation', '=', '7'),
+      '|', ('justification_end_date', '=', False), ('justification_end_date', '<', today),
+    ]]))
+    to_r1 = expired_justifications._transition_situation('7', '1')
+
+    # R1 notificadas sin fecha: el plazo de aviso empieza hoy
+    undated_notifications = Cancellation.search(expression.AND([base_domain, [
+      ('situation', '=', '3'),
+      ('notification_date', '=', False),
+    ]]))
+    if undated_notifications:
+      undated_notifications.write({'notification_date': today})
+      _logger.warning(f'{len(undated_notifications)} anulaciones notificadas sin fecha de notificación: se toma la de hoy')
+
+    # 3 -> 4
+    expired_notifications = Cancellation.search(expression.AND([base_domain, [
+      ('situation', '=', '3'),
+      ('notification_date', '<=', today - timedelta(days = NUM_DIAS_AVISO)),
+    ]]))
+    to_r2 = expired_notifications._transition_situation('3', '4')
+
+    print(f'\033[0;34m[INFO]\033[0m Escalado de riesgo{f" en el ciclo {course_id}" if course_id else ""}: '
+          f'{len(to_r1)} justificaciones caducadas -> R1, {len(to_r2)} notificadas -> R2')
+
+    # Notificaciones para los profesores sólo de las que han cambiado
+    if to_r2:
+      Cancellation.create_notification_items(
+        [(c_id, 'R1_notificada->R2_pendiente') for c_id in to_r2.ids],
+        self.env.ref('maya_students.notification_group_exofficio_cancellations').id)
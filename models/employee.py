@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields, models
+
+class Employee(models.Model):
+  """
+  Herencia del modelo maya_core.employee para mantener sincronizado el profesorado
+  (almacenado) de las anulaciones cuando cambia el email de un empleado
+  """
+  _inherit = 'maya_core.employee'
+
+  # indexado: lo utiliza la regla de registro de las anulaciones de los profesores
+  user_id = fields.Many2one(index = True)
+
+  def _teacher_pairs(self):
+    """
+    Pares (módulo, ciclo) en los que los empleados son profesores
+    """
+    return self.env['maya_core.subject_employee_rel'].sudo().search([
+      ('employee_id', 'in', self.ids)
+    ])._subject_course_pairs()
+
+  def write(self, vals):
+    res = super().write(vals)
+    if 'work_email' in vals:
+      self.env['maya_students.cancellation']._recompute_teacher_employees(self._teacher_pairs())
+    return res
+
+  def unlink(self):
+    # sólo afecta al profesorado de las anulaciones si los empleados tienen asignaciones
+    pairs = self._teacher_pairs()
+    res = super().unlink()
+    self.env['maya_students.cancellation']._recompute_teacher_employees(pairs)
+    return res
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from odoo import api, models, fields
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# nº de paquetes (mensajes) por lote encolado
+DEFAULT_JOB_SIZE = 50
+# reintentos de los paquetes cuyo envío falla y espera inicial entre ellos (se duplica en cada intento)
+MAX_ATTEMPTS = 3
+RETRY_BASE_MINUTES = 5
+# minutos sin cambios tras los que un lote 'running' se considera interrumpido
+DEFAULT_RUNNING_TIMEOUT_MINUTES = 60
+
+class NotificationJob(models.Model):
+  """
+  Lote de notificaciones agrupadas de anulaciones de oficio pendiente de envío.
+  La acción de envío agrupado sólo reserva las anulaciones (situation '2') y crea 
+  los lotes. Los mensajes los genera y envía en segundo plano el cron 
+  cron_process_notification_jobs, reintentando los fallidos
+  """
+  _name = 'maya_students.notification_job'
+  _description = 'Lote de notificaciones de anulaciones en cola'
+  _order = 'id desc'
+
+  name = fields.Char(string = 'Lote', required = True, readonly = True)
+
+  state = fields.Selection([
+    ('queued', 'En cola'),
+    ('running', 'Enviando'),
+    ('done', 'Terminado'),
+    ('failed', 'Con errores'),
+    ], string = 'Estado', default = 'queued', required = True, readonly = True, index = True)
+
+  user_id = fields.Many2one('res.users', string = 'Solicitado por', readonly = True,
+                            default = lambda self: self.env.user)
+
+  # lista de dicts {'main_id': int, 'related_ids': [int,...]} pendientes de enviar
+  packages = fields.Json(string = 'Paquetes pendientes', readonly = True)
+
+  total = fields.Integer(string = 'Mensajes', readonly = True)
+  sent = fields.Integer(string = 'Enviados', readonly = True)
+  failed = fields.Integer(string = 'Fallidos', readonly = True)
+  progress = fields.Float(string = 'Progreso', compute = '_compute_progress')
+
+  attempts = fields.Integer(string = 'Intentos', readonly = True)
+  next_attempt = fields.Datetime(string = 'Próximo intento', readonly = True, index = True,
+                                 default = lambda self: fields.Datetime.now())
+  last_error = fields.Text(string = 'Último error', readonly = True)
+
+  @api.depends('total', 'sent', 'failed')
+  def _compute_progress(self):
+    for record in self:
+      record.progress = 100.0 * (record.sent + record.failed) / record.total if record.total else 0.0
+
+  @api.model
+  def _enqueue(self, packages: list):
+    """
+    Crea los lotes para los paquetes ya reservados y despierta al cron que los envía.
+    Los usuarios sólo pueden leer los lotes: se crean como superusuario
+
+    :packages lista de dicts {'main_id': int, 'related_ids': [int,...]}
+
+    :return lotes creados
+    """
+    if not packages:
+      return self
+    
+    job_size = max(1, int(self.env['ir.config_parameter'].sudo().get_param(
+      'maya_students.notification_job_size', DEFAULT_JOB_SIZE)))
+    
+    now = fields.Datetime.now()
+
+    jobs = self.sudo().create([
+      { 'name': f'{now.strftime("%Y%m%d-%H%M%S")}/{n + 1}',
+        'user_id': self.env.user.id,
+        'packages': packages[i:i + job_size],
+        'total': len(packages[i:i + job_size]) }
+      for n, i in enumerate(range(0, len(packages), job_size))
+    ])
+
+    self.env.ref('maya_students.cron_process_notification_jobs').sudo()._trigger()
+
+    return jobs.sudo(False)
+
+  @api.model
+  def cron_process_notification_jobs(self):
+    """
+    Envía los lotes en cola. Cada lote se confirma en la BD por separado. 
+    Los paquetes que fallan se reintentan con espera exponencial; al agotar 
+    los intentos sus anulaciones vuelven a 'R1 - sin notificar'
+    """
+    if self._requeue_stale_jobs():
+      self.env.cr.commit()
+
+    jobs = self.search([
+      ('state', '=', 'queued'),
+      ('next_attempt', '<=', fields.Datetime.now())
+    ], order = 'id')
+
+    for job in jobs:
+      job.state = 'running'
+      self.env.cr.commit()
+
+      try:
+        job._process()
+      except Exception as e:
+        self.env.cr.rollback()
+        _logger.error(f"Error procesando el lote de notificaciones {job.name}: {str(e)}")
+        job._schedule_retry(job.packages or [], str(e))
+
+      self.env.cr.commit()
+
+  @api.model
+  def _requeue_stale_jobs(self):
+    """
+    Vuelve a poner en cola (como un intento fallido más) los lotes que llevan en 'running'
+    más de 'maya_students.notification_job_timeout' minutos: el proceso que los enviaba 
+    terminó sin cerrarlos (reinicio del servidor, proceso terminado...). Sólo se conservan
+    los paquetes cuya anulación principal sigue reservada ('2')
+
+    :return lotes vueltos a poner en cola
+    """
+    timeout = int(self.env['ir.config_parameter'].sudo().get_param(
+      'maya_students.notification_job_timeout', DEFAULT_RUNNING_TIMEOUT_MINUTES))
+
+    stale_jobs = self.search([
+      ('state', '=', 'running'),
+      ('write_date', '<', fields.Datetime.now() - timedelta(minutes = timeout))
+    ], order = 'id')
+
+    if not stale_jobs:
+      return stale_jobs
+
+    main_ids = [pkg['main_id'] for job in stale_jobs for pkg in job.packages or []]
+    reserved_ids = set(self.env['maya_students.cancellation'].search([
+      ('id', 'in', main_ids),
+      ('situation', '=', '2')
+    ]).ids)
+
+    for job in stale_jobs:
+      _logger.warning(f"Lote de notificaciones {job.name} interrumpido durante el envío, se vuelve a poner en cola")
+      job._schedule_retry([pkg for pkg in job.packages or [] if pkg['main_id'] in reserved_ids],
+                          f'Envío interrumpido (más de {timeout} minutos en curso)')
+
+    return stale_jobs
+
+  def _process(self):
+    """
+    Genera y envía los mensajes pendientes del lote
+    """
+    self.ensure_one()
+
+    last_attempt = self.attempts + 1 >= MAX_ATTEMPTS
+
+    result = self.env['maya_students.cancellation']._deliver_notification_packages(
+      self.packages or [], revert_failed = last_attempt)
+    
+    self.write({
+      'sent': self.sent + result['sent'],
+      # los errores de generación no se reintentan: sus anulaciones ya vuelven a '1'
+      'failed': self.failed + len(result['generation_errors']),
+    })
+
+    if result['failed_packages']:
+      self._schedule_retry(result['failed_packages'], f"{result['failed']} mensajes no enviados")
+    else:
+      self.write({
+        'state': 'failed' if self.failed else 'done',
+        'packages': [],
+        'attempts': self.attempts + 1,
+      })
+
+  def _schedule_retry(self, packages: list, error: str):
+    """
+    Deja en cola los paquetes fallidos con espera exponencial, o marca el lote 
+    como fallido si se han agotado los intentos
+    """
+    self.ensure_one()
+    attempts = self.attempts + 1
+
+    if attempts >= MAX_ATTEMPTS:
+      # sin más intentos: las anulaciones que sigan reservadas vuelven a '1'
+      ids = [c_id for pkg in packages for c_id in [pkg['main_id']] + pkg.get('related_ids', [])]
+      self.env['maya_students.cancellation'].browse(ids)._transition_situation('2', '1')
+
+      self.write({
+        'state': 'failed',
+        'packages': [],
+        'failed': self.failed + len(packages),
+        'attempts': attempts,
+        'last_error': error,
+      })
+    else:
+      self.write({
+        'state': 'queued',
+        'packages': packages,
+        'attempts': attempts,
+        'next_attempt': fields.Datetime.now() + timedelta(minutes = RETRY_BASE_MINUTES * 2 ** (attempts - 1)),
+        'last_error': error,
+      })
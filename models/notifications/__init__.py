@@ -1,2 +1,3 @@
 # -*- coding: utf-8 -*-
-from . import notification_group
\ No newline at end of file
+from . import notification_group
+from . import notification_item
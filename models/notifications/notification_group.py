@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from odoo import api, models, fields
+from collections import defaultdict
 
 class NotificationGroup(models.Model):
   """
@@ -21,25 +22,42 @@ class NotificationGroup(models.Model):
     
     :return HTML listo para insertar.
     """  
+    return self.render_blocks(user, group).get(user.id, "")
 
-    provider = self.env.ref('maya_students.notification_provider')  
-    
-    notifications = self.env['maya_core.notification_item'].search([
-        ('user_id', '=', user.id),
-        ('provider_id', '=', provider.id),
-        ('ngroup_id', '=', group.id)
-    ])   
+  def render_blocks(self, users, group) -> dict:
+    """
+    Genera los bloques HTML de varios usuarios a la vez. Las notificaciones de
+    todos ellos se obtienen con una única búsqueda
 
-    if not notifications:
-      return ""
+    :users Usuarios odoo a los que hay que notificar
+    :group Grupo de notificaciones del proveedor actual sobre el que se renderizan
+           las notificaciones
     
-    if group.id == self.env.ref('maya_students.notification_group_exofficio_cancellations').id:
+    :return diccionario user.id -> HTML listo para insertar (sólo usuarios con notificaciones)
+    """
+    # ir.model.data cachea la resolución de los xmlid
+    xmlid_to_res_id = self.env['ir.model.data']._xmlid_to_res_id
+
+    if group.id == xmlid_to_res_id('maya_students.notification_group_exofficio_cancellations', raise_if_not_found = False):
       template = "maya_students.notification_cancellation_teacher_task"
     else:  
       print('No se encuentra el grupo')
-      return ""
+      return {}
+
+    notifications = self.env['maya_core.notification_item'].search([
+        ('user_id', 'in', users.ids),
+        ('provider_id', '=', xmlid_to_res_id('maya_students.notification_provider')),
+        ('ngroup_id', '=', group.id)
+    ])   
+
+    notifications_by_user = defaultdict(lambda: self.env['maya_core.notification_item'])
+    for notification in notifications:
+      notifications_by_user[notification.user_id.id] |= notification
+
+    # la plantilla se compila una vez y ir.qweb la reutiliza para todos los usuarios
+    render_template = self.env['ir.ui.view']._render_template
 
-    return self.env['ir.ui.view']._render_template(
-      template,{
-        "notifications": notifications,
-    })
\ No newline at end of file
+    return { user_id: render_template(template, {
+                        "notifications": user_notifications,
+                      })
+             for user_id, user_notifications in notifications_by_user.items() }
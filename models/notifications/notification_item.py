@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields
+
+class NotificationItem(models.Model):
+  """
+  Hereda de maya_core.notification_item para guardar a qué ciclo, módulo y anulaciones
+  de oficio corresponde una notificación de llamadas pendientes (R2). Así los casos 
+  nuevos se añaden a la notificación del mismo profesor, ciclo y módulo por sus ids
+  """
+
+  _inherit = "maya_core.notification_item"
+
+  cancellation_course_id = fields.Many2one('maya_core.course', string = 'Ciclo de las anulaciones',
+                                           ondelete = 'cascade', index = True)
+  cancellation_subject_id = fields.Many2one('maya_core.subject', string = 'Módulo de las anulaciones',
+                                            ondelete = 'cascade', index = True)
+  cancellation_ids = fields.Many2many('maya_students.cancellation',
+        'maya_students_notification_item_cancellation_rel', 'item_id', 'cancellation_id',
+        string = 'Anulaciones pendientes de llamada')
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields, models
+
+class Student(models.Model):
+  """
+  Herencia del modelo maya_core.student para guardar la huella de sus datos
+  de ITACA y evitar sincronizaciones innecesarias
+  """
+  _inherit = 'maya_core.student'
+
+  itaca_row_hash = fields.Char(string = 'Huella ITACA', readonly = True,
+                               help = 'Huella de los datos de ITACA en la última sincronización')
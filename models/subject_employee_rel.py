@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models
+
+TEACHER_FIELDS = {'subject_id', 'course_id', 'employee_id'}
+
+class SubjectEmployeeRel(models.Model):
+  """
+  Herencia del modelo maya_core.subject_employee_rel para mantener sincronizado
+  el profesorado (almacenado) de las anulaciones cuando cambian las asignaciones
+  """
+  _inherit = 'maya_core.subject_employee_rel'
+
+  def _subject_course_pairs(self):
+    return { (record.subject_id.id, record.course_id.id) for record in self }
+
+  @api.model_create_multi
+  def create(self, vals_list):
+    records = super().create(vals_list)
+    self.env['maya_students.cancellation']._recompute_teacher_employees(records._subject_course_pairs())
+    return records
+
+  def write(self, vals):
+    # sólo cambia el profesorado si cambian el módulo, el ciclo o el empleado
+    if not TEACHER_FIELDS & set(vals):
+      return super().write(vals)
+
+    pairs = self._subject_course_pairs()
+    res = super().write(vals)
+    self.env['maya_students.cancellation']._recompute_teacher_employees(pairs | self._subject_course_pairs())
+    return res
+
+  def unlink(self):
+    pairs = self._subject_course_pairs()
+    res = super().unlink()
+    self.env['maya_students.cancellation']._recompute_teacher_employees(pairs)
+    return res
@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+
+"""
+Banco de pruebas de rendimiento de la comprobación de asistencia y del envío
+agrupado de notificaciones.
+
+Genera un curso escolar sintético (N ciclos x M aulas compartidas x K estudiantes
+por ciclo, con un porcentaje de estudiantes en riesgo y el fichero de ITACA
+correspondiente), ejecuta el cron de asistencia contra un Moodle simulado en el
+propio proceso (por curso con cron_check_attendance_school_year y por ciclo con
+cron_check_attendance_classroom, como los crons registrados) y el envío agrupado
+contra un servidor SMTP local que descarta los
+mensajes. De cada fase se mide el tiempo, el número de consultas SQL y el pico de
+memoria reservada por Python durante la fase (tracemalloc), y se compara con una
+referencia guardada en JSON.
+
+El cron confirma (commit) los cambios, por lo que SOLO debe ejecutarse sobre una
+base de datos desechable con el parámetro 'maya_students.benchmark_enabled' activo:
+
+  $ odoo-bin shell -d maya_bench
+  >>> from odoo.addons.maya_students.support.benchmark import run_benchmark
+  >>> run_benchmark(env, cycles = 4, classrooms = 30, students = 40, baseline = '/tmp/maya_bench.json')
+
+La primera vez (o con update_baseline = True) se guarda la referencia. En las
+siguientes, si alguna medida empeora más del umbral se lanza BenchmarkRegression.
+
+También se puede ejecutar como prueba de Odoo (sin confirmar nada en la BD), con
+la referencia opcional en la variable de entorno MAYA_BENCHMARK_BASELINE:
+
+  $ odoo-bin -d maya_bench -u maya_students --test-enable --test-tags benchmark --stop-after-init
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import socketserver
+import tracemalloc
+import threading
+import logging
+import random
+import json
+import time
+import csv
+import os
+import uuid
+
+from odoo.exceptions import UserError
+
+from .moodle_source import MOODLE_SOURCE_CONTEXT_KEY
+from ...maya_core.support.helper import get_mail_server
+
+_logger = logging.getLogger(__name__)
+
+# empeoramiento máximo permitido respecto a la referencia (20%)
+DEFAULT_THRESHOLD = 0.2
+
+# medidas que se comparan con la referencia
+COMPARED_METRICS = ('wall', 'queries', 'peak_mem_kb')
+
+# columnas del fichero de ITACA sintético
+ITACA_COLUMNS = ['NIA', 'Nombre', 'Apellido1', 'Apellido2', 'Email', 'Teléfono', 'Código de curso']
+ITACA_DELIMITER = ';'
+
+# rangos de identificadores de los datos sintéticos
+BASE_NIA = 90000000
+BASE_MOODLE_CLASSROOM_ID = 900000
+BASE_MOODLE_USER_ID = 9000000
+
+class BenchmarkRegression(Exception):
+  """
+  Alguna medida ha empeorado más del umbral respecto a la referencia
+  """
+  def __init__(self, regressions: list):
+    self.regressions = regressions
+    super().__init__('Regresiones de rendimiento: ' + ', '.join(
+      f"{r['phase']}.{r['metric']} {r['baseline']} -> {r['value']}" for r in regressions))
+
+class FakeMoodleSource:
+  """
+  Moodle simulado en el propio proceso (ver support.moodle_source)
+
+  :classrooms_users diccionario moodle_id del aula -> lista de usuarios
+  :latency segundos de espera por cada petición, para simular la red
+  """
+  def __init__(self, classrooms_users: dict, latency: float = 0.0):
+    self.classrooms_users = classrooms_users
+    self.latency = latency
+    self.requests = 0
+    self._lock = threading.Lock()
+
+  def connect(self):
+    return None
+
+  def course_students(self, conn, moodle_id: int) -> list:
+    with self._lock:
+      self.requests += 1
+
+    if self.latency:
+      time.sleep(self.latency)
+
+    if moodle_id not in self.classrooms_users:
+      raise Exception(f'Aula {moodle_id} no encontrada en el Moodle simulado')
+
+    return self.classrooms_users[moodle_id]
+
+class _SmtpSinkHandler(socketserver.StreamRequestHandler):
+  """
+  Implementación mínima del protocolo SMTP: acepta y descarta todos los mensajes
+  """
+  def reply(self, line: str):
+    self.wfile.write((line + '\r\n').encode())
+
+  def handle(self):
+    self.reply('220 maya-benchmark ESMTP')
+    in_data = False
+    auth_login_steps = 0
+
+    for raw_line in self.rfile:
+      line = raw_line.decode(errors = 'replace').rstrip('\r\n')
+
+      if in_data:
+        if line == '.':
+          in_data = False
+          self.server.count_message()
+          self.reply('250 OK')
+        continue
+
+      if auth_login_steps:
+        auth_login_steps -= 1
+        self.reply('334 UGFzc3dvcmQ6' if auth_login_steps else '235 OK')
+        continue
+
+      command = line[:4].upper()
+      if command == 'EHLO':
+        self.reply('250-maya-benchmark')
+        self.reply('250-AUTH PLAIN LOGIN')
+        self.reply('250 8BITMIME')
+      elif command == 'AUTH':
+        if line.upper().startswith('AUTH LOGIN'):
+          auth_login_steps = 1 if len(line.split()) > 2 else 2
+          self.reply('334 UGFzc3dvcmQ6' if auth_login_steps == 1 else '334 VXNlcm5hbWU6')
+        else:
+          self.reply('235 OK')
+      elif command == 'DATA':
+        in_data = True
+        self.reply('354 End data with <CR><LF>.<CR><LF>')
+      elif command == 'QUIT':
+        self.reply('221 Bye')
+        return
+      else:
+        # HELO, MAIL, RCPT, RSET, NOOP...
+        self.reply('250 OK')
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+  """
+  Servidor SMTP local que descarta los mensajes y cuenta los recibidos.
+  Se utiliza como gestor de contexto: arranca en un puerto libre de 127.0.0.1
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self):
+    super().__init__(('127.0.0.1', 0), _SmtpSinkHandler)
+    self.messages = 0
+    self._lock = threading.Lock()
+
+  @property
+  def port(self) -> int:
+    return self.server_address[1]
+
+  def count_message(self):
+    with self._lock:
+      self.messages += 1
+
+  def __enter__(self):
+    threading.Thread(target = self.serve_forever, daemon = True).start()
+    return self
+
+  def __exit__(self, *args):
+    self.shutdown()
+    self.server_close()
+
+@contextmanager
+def measure(env, results: dict, phase: str):
+  """
+  Mide el tiempo, las consultas SQL y el pico de memoria de una fase y lo guarda
+  en results[phase]. El pico es el de la memoria reservada por Python desde el
+  inicio de la fase (tracemalloc), no el máximo del proceso, que sólo puede crecer
+  """
+  started_tracing = not tracemalloc.is_tracing()
+  if started_tracing:
+    tracemalloc.start()
+  tracemalloc.reset_peak()
+  start_memory = tracemalloc.get_traced_memory()[0]
+
+  start_queries = env.cr.sql_log_count
+  start = time.perf_counter()
+
+  try:
+    yield
+  finally:
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    if started_tracing:
+      tracemalloc.stop()
+
+  results[phase] = {
+    'wall': round(time.perf_counter() - start, 3),
+    'queries': env.cr.sql_log_count - start_queries,
+    'peak_mem_kb': max(0, peak_memory - start_memory) // 1024,
+  }
+  _logger.info(f'Benchmark {phase}: {results[phase]}')
+
+def generate_school_year(env, itaca_file: str, cycles: int = 4, classrooms: int = 20, students: int = 30,
+                         risk_ratio: float = 0.2, shared: int = 2, seed: int = 1) -> dict:
+  """
+  Genera los datos sintéticos de un curso escolar: ciclos y módulos en la BD,
+  los usuarios de cada aula del Moodle simulado y el fichero de ITACA
+
+  :itaca_file ruta del fichero de ITACA a generar
+  :cycles número de ciclos
+  :classrooms número de aulas (una por módulo)
+  :students número de estudiantes de cada ciclo
+  :risk_ratio proporción de estudiantes que no se conectan a cada aula
+  :shared número de ciclos que comparten cada aula
+  :seed semilla para que los datos sean reproducibles
+
+  :return diccionario con 'check_classrooms' (lista de tuplas (moodle_id, id del módulo,
+          id del ciclo)), 'classrooms_users' (moodle_id -> usuarios) y 'course_ids'
+  """
+  rnd = random.Random(seed)
+  tag = uuid.uuid4().hex[:6].upper()
+
+  courses = env['maya_core.course'].create([{
+    'name': f'Benchmark {tag} ciclo {i}',
+    'code': f'BCH{tag}{i}',
+    'abbr': f'BCH{i}',
+  } for i in range(cycles)])
+
+  subjects = env['maya_core.subject'].create([{
+    'name': f'Benchmark {tag} módulo {j}',
+    'code': f'BCH{tag}{j}',
+  } for j in range(classrooms)])
+
+  # cada aula la comparten 'shared' ciclos consecutivos
+  classroom_courses = { j: [courses[(j + k) % cycles] for k in range(min(shared, cycles))]
+                        for j in range(classrooms) }
+
+  recent_access = int((datetime.now() - timedelta(days = 1)).timestamp())
+  old_access = int((datetime.now() - timedelta(days = 30)).timestamp())
+
+  # estudiantes de cada ciclo y fichero de ITACA
+  course_students = {}
+  with open(itaca_file, 'w', newline = '', encoding = 'utf-8') as f:
+    writer = csv.writer(f, delimiter = ITACA_DELIMITER)
+    writer.writerow(ITACA_COLUMNS)
+
+    for i, course in enumerate(courses):
+      course_students[course.id] = []
+      for k in range(students):
+        n = i * students + k
+        nia = str(BASE_NIA + n)
+        course_students[course.id].append(SimpleNamespace(
+          id = BASE_MOODLE_USER_ID + n,
+          username = nia,
+          idnumber = nia,
+          firstname = f'Estudiante {n}',
+          lastname = f'Benchmark {tag}',
+          fullname = f'Estudiante {n} Benchmark {tag}',
+          email = f'bch{tag.lower()}.{n}@benchmark.invalid',
+        ))
+        writer.writerow([nia, f'Estudiante {n}', 'Benchmark', tag, f'bch{tag.lower()}.{n}@benchmark.invalid',
+                         '600000000', course.code])
+
+  # usuarios de cada aula (el último acceso depende del aula)
+  check_classrooms = []
+  classrooms_users = {}
+  for j, subject in enumerate(subjects):
+    moodle_id = BASE_MOODLE_CLASSROOM_ID + j
+    classrooms_users[moodle_id] = []
+
+    for course in classroom_courses[j]:
+      check_classrooms.append((moodle_id, subject.id, course.id))
+      for student in course_students[course.id]:
+        user = SimpleNamespace(**vars(student))
+        user.lastcourseaccess = old_access if rnd.random() < risk_ratio else recent_access
+        user.lastaccess = user.lastcourseaccess
+        classrooms_users[moodle_id].append(user)
+
+  return {
+    'check_classrooms': check_classrooms,
+    'classrooms_users': classrooms_users,
+    'course_ids': courses.ids,
+  }
+
+@contextmanager
+def _config_parameters(env, values: dict):
+  """
+  Cambia temporalmente los parámetros de configuración indicados
+  """
+  params = env['ir.config_parameter'].sudo()
+  previous = { key: params.get_param(key) for key in values }
+
+  for key, value in values.items():
+    params.set_param(key, value)
+  try:
+    yield
+  finally:
+    for key, value in previous.items():
+      params.set_param(key, value or False)
+
+@contextmanager
+def _mail_server_to(env, port: int):
+  """
+  Dirige temporalmente el servidor de correo del centro al SMTP local
+  """
+  mail_server = get_mail_server(env['maya_students.cancellation'], 'centro')
+  fnames = ['smtp_host', 'smtp_port', 'smtp_encryption']
+  previous = mail_server.read(fnames)[0]
+
+  mail_server.write({'smtp_host': '127.0.0.1', 'smtp_port': port, 'smtp_encryption': 'none'})
+  try:
+    yield
+  finally:
+    mail_server.write({ fname: previous[fname] for fname in fnames })
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+  """
+  Compara las medidas con la referencia
+
+  :return lista de dicts {'phase', 'metric', 'baseline', 'value'} con las medidas
+          que han empeorado más del umbral
+  """
+  regressions = []
+  for phase, metrics in results.get('phases', {}).items():
+    for metric in COMPARED_METRICS:
+      reference = baseline.get('phases', {}).get(phase, {}).get(metric)
+      value = metrics.get(metric)
+      if reference and value is not None and value > reference * (1 + threshold):
+        regressions.append({'phase': phase, 'metric': metric, 'baseline': reference, 'value': value})
+
+  return regressions
+
+def run_benchmark(env, cycles: int = 4, classrooms: int = 20, students: int = 30, risk_ratio: float = 0.2,
+                  shared: int = 2, seed: int = 1, moodle_latency: float = 0.0, baseline: str = None,
+                  threshold: float = DEFAULT_THRESHOLD, update_baseline: bool = False) -> dict:
+  """
+  Ejecuta el banco de pruebas completo (ver la documentación del módulo)
+
+  :moodle_latency segundos de espera de cada petición al Moodle simulado
+  :baseline ruta del JSON de referencia. Si no existe (o update_baseline) se crea
+  :threshold empeoramiento máximo permitido (0.2 = 20%)
+
+  :return diccionario con los parámetros, las medidas de cada fase y las regresiones
+  """
+  if env['ir.config_parameter'].sudo().get_param(
+      'maya_students.benchmark_enabled', 'False').lower() not in ('1', 'true'):
+    raise UserError('El banco de pruebas confirma datos sintéticos en la BD. Actívelo con el parámetro '
+                    '"maya_students.benchmark_enabled" sólo en una base de datos desechable')
+
+  from ..models.cron_register_jobs.cron_check_attendance_classroom import ITACA_DIR
+
+  params = {
+    'cycles': cycles, 'classrooms': classrooms, 'students': students, 'risk_ratio': risk_ratio,
+    'shared': shared, 'seed': seed, 'moodle_latency': moodle_latency,
+  }
+  results = {'params': params, 'phases': {}}
+  phases = results['phases']
+
+  itaca_filename = f'benchmark_{uuid.uuid4().hex}.csv'
+  itaca_file = os.path.join(ITACA_DIR, itaca_filename)
+
+  try:
+    with measure(env, phases, 'generate'):
+      data = generate_school_year(env, itaca_file, cycles, classrooms, students, risk_ratio, shared, seed)
+
+    source = FakeMoodleSource(data['classrooms_users'], latency = moodle_latency)
+
+    with _config_parameters(env, {
+        'maya_core.itaca_students_data': itaca_filename,
+        'maya_students.notification_queue': 'False',
+      }):
+      with measure(env, phases, 'attendance'):
+        env['maya_students.cron_check_attendance_classroom'].with_context(**{
+          MOODLE_SOURCE_CONTEXT_KEY: source,
+        }).cron_check_attendance_school_year(data['check_classrooms'])
+
+      # segunda pasada por ciclo (una ejecución por ciclo, como los crons registrados): 
+      # las anulaciones ya existen y se actualizan
+      classroom_source = FakeMoodleSource(data['classrooms_users'], latency = moodle_latency)
+      classrooms_by_course = {}
+      for moodle_id, subject_id, course_id in data['check_classrooms']:
+        classrooms_by_course.setdefault(course_id, []).append((moodle_id, subject_id))
+
+      with measure(env, phases, 'attendance_classroom'):
+        for course_id, classrooms_id in classrooms_by_course.items():
+          env['maya_students.cron_check_attendance_classroom'].with_context(**{
+            MOODLE_SOURCE_CONTEXT_KEY: classroom_source,
+          }).cron_check_attendance_classroom(classrooms_id, course_id)
+
+      cancellations = env['maya_students.cancellation'].search([
+        ('cancellation_type', '=', 'OFC'),
+        ('situation', '=', '1'),
+        ('subject_student_rel_id.course_id', 'in', data['course_ids']),
+      ])
+
+      with SmtpSink() as sink, _mail_server_to(env, sink.port):
+        with measure(env, phases, 'notifications'):
+          cancellations.send_notification_mail_subject_agruped()
+
+    results['counts'] = {
+      'classrooms': len(data['classrooms_users']),
+      'check_classrooms': len(data['check_classrooms']),
+      'moodle_requests': source.requests,
+      'moodle_requests_classroom': classroom_source.requests,
+      'cancellations': len(cancellations),
+      'mails_received': sink.messages,
+    }
+  finally:
+    if os.path.exists(itaca_file):
+      os.remove(itaca_file)
+
+  if not baseline:
+    return results
+
+  if update_baseline or not os.path.exists(baseline):
+    with open(baseline, 'w', encoding = 'utf-8') as f:
+      json.dump(results, f, indent = 2)
+    _logger.info(f'Benchmark: referencia guardada en {baseline}')
+    return results
+
+  with open(baseline, encoding = 'utf-8') as f:
+    reference = json.load(f)
+
+  if reference.get('params') != params:
+    _logger.warning(f'Benchmark: la referencia se obtuvo con otros parámetros {reference.get("params")}')
+
+  results['regressions'] = compare_with_baseline(results, reference, threshold)
+  if results['regressions']:
+    raise BenchmarkRegression(results['regressions'])
+
+  return results
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+Caché a nivel de proceso de los ficheros de ITACA ya procesados.
+
+El cron de comprobación de asistencia se registra por ciclo, por lo que el mismo
+fichero de ITACA se procesaría una vez por ciclo cada noche. Con la caché se 
+procesa una sola vez por versión del fichero (ruta, fecha de modificación y tamaño)
+en cada worker. 
+
+Opcionalmente, si está disponible pyarrow y se indica un directorio, se guarda 
+además una copia en formato columnar (feather) para que un worker recién arrancado 
+la cargue sin tener que volver a procesar el CSV. La carga convierte la tabla en un
+DataFrame, por lo que ocupa la misma memoria que el procesado del CSV: lo que se 
+ahorra es el tiempo de procesado. El data_stack se guarda como JSON en los metadatos
+del esquema de la tabla (nunca con pickle: el directorio puede ser compartido y 
+cargar un pickle ejecuta código arbitrario).
+
+El DataFrame devuelto es compartido: debe tratarse como de solo lectura.
+
+Sobre cada versión se construye también (bajo demanda) un índice NIA -> filas 
+para que la búsqueda de un estudiante no dependa del tamaño del fichero.
+"""
+
+from collections import OrderedDict
+import threading
+import hashlib
+import logging
+import json
+import os
+
+import pandas as pd
+
+from ...maya_core.support.helper import read_itaca_csv
+
+try:
+  import pyarrow
+  import pyarrow.feather as feather
+except ImportError:
+  feather = None
+
+_logger = logging.getLogger(__name__)
+
+# límites por defecto de la caché
+DEFAULT_MAX_ENTRIES = 4
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024  # 512 MB
+
+# columna del fichero de ITACA con el NIA del estudiante
+ITACA_NIA_COLUMN = 'NIA'
+
+# clave de los metadatos de la copia columnar con el data_stack (JSON)
+DATA_STACK_METADATA_KEY = b'maya_students.data_stack'
+
+# (ruta, mtime, tamaño) -> [df, data_stack, bytes en memoria, índice NIA]
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def read_itaca_csv_cached(csv_file: str, cache_dir: str = None,
+                          max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES):
+  """
+  Igual que read_itaca_csv pero utilizando la caché del proceso
+
+  :csv_file ruta del fichero de ITACA
+  :cache_dir directorio donde guardar/leer la copia columnar. None para no usarla
+  :max_entries número máximo de versiones de ficheros en memoria
+  :max_bytes memoria máxima (aproximada) ocupada por los DataFrame en caché
+
+  :return tupla (df, data_stack) como read_itaca_csv
+  """
+  stat = os.stat(csv_file)
+  key = (os.path.abspath(csv_file), stat.st_mtime_ns, stat.st_size)
+
+  with _cache_lock:
+    if key in _cache:
+      _cache.move_to_end(key)
+      df, data_stack = _cache[key][:2]
+      return df, data_stack
+
+  data = _read_columnar(key, cache_dir) if cache_dir else None
+
+  if data is None:
+    _logger.info(f'ITACA: procesando el fichero {csv_file}')
+    data = read_itaca_csv(csv_file)
+
+    if cache_dir:
+      _write_columnar(key, cache_dir, *data)
+
+  df, data_stack = data
+
+  with _cache_lock:
+    _cache[key] = [df, data_stack, _memory_usage(df), None]
+    _evict(max_entries, max_bytes)
+
+  return df, data_stack
+
+def get_itaca_index(df, nia_column: str = ITACA_NIA_COLUMN):
+  """
+  Devuelve el índice NIA del DataFrame. Si el DataFrame está en la caché el 
+  índice se construye una sola vez y se guarda con él
+  """
+  with _cache_lock:
+    entry = next((entry for entry in _cache.values() if entry[0] is df), None)
+    if entry is not None and entry[3] is not None and entry[3].nia_column == nia_column:
+      return entry[3]
+
+  index = ItacaIndex(df, nia_column)
+
+  if entry is not None:
+    with _cache_lock:
+      entry[3] = index
+
+  return index
+
+class ItacaIndex:
+  """
+  Índice NIA -> posiciones de las filas del estudiante en el DataFrame de ITACA.
+  Si el DataFrame no tiene la columna del NIA, las búsquedas devuelven el 
+  DataFrame completo
+  """
+
+  def __init__(self, df, nia_column: str = ITACA_NIA_COLUMN):
+    self.df = df
+    self.nia_column = nia_column
+
+    if nia_column in df.columns:
+      keys = df[nia_column].astype(str).str.strip()
+      self._positions = df.groupby(keys, sort = False).indices
+    else:
+      _logger.warning(f'ITACA: el fichero no tiene la columna {nia_column}, no se indexa')
+      self._positions = None
+
+  def rows(self, nia):
+    """
+    Devuelve las filas (DataFrame) del estudiante
+    """
+    if self._positions is None:
+      return self.df
+    
+    return self.df.iloc[self._positions.get(str(nia or '').strip(), [])]
+
+  def row_hash(self, nia) -> str:
+    """
+    Devuelve una huella de las filas del estudiante o None si no está indexado
+    o no aparece en el fichero
+    """
+    if self._positions is None:
+      return None
+    
+    rows = self.rows(nia)
+    if rows.empty:
+      return None
+    
+    return hashlib.sha1(pd.util.hash_pandas_object(rows, index = False).values.tobytes()).hexdigest()
+
+def clear_itaca_cache():
+  """
+  Vacía la caché en memoria
+  """
+  with _cache_lock:
+    _cache.clear()
+
+def _memory_usage(df) -> int:
+  try:
+    return int(df.memory_usage(deep = True).sum())
+  except Exception:
+    return 0
+
+def _evict(max_entries: int, max_bytes: int):
+  """
+  Elimina las entradas usadas hace más tiempo hasta cumplir los límites. 
+  La entrada más reciente no se elimina nunca.
+  """
+  while len(_cache) > 1 and \
+      (len(_cache) > max_entries or sum(entry[2] for entry in _cache.values()) > max_bytes):
+    evicted_key, _ = _cache.popitem(last = False)
+    _logger.info(f'ITACA: eliminada de la caché la versión {evicted_key}')
+
+def _columnar_path(key, cache_dir: str):
+  path, mtime, size = key
+  return os.path.join(cache_dir, f'{os.path.basename(path)}.{mtime}.{size}.feather')
+
+def _read_columnar(key, cache_dir: str):
+  """
+  Lee la copia columnar del fichero y la convierte en DataFrame (es una copia en 
+  memoria, no un mapeo del fichero). None si no existe o no se puede leer
+  """
+  if feather is None:
+    return None
+  
+  feather_file = _columnar_path(key, cache_dir)
+  if not os.path.exists(feather_file):
+    return None
+  
+  try:
+    table = feather.read_table(feather_file)
+    data_stack = json.loads((table.schema.metadata or {})[DATA_STACK_METADATA_KEY])
+    df = table.to_pandas()
+  except Exception as e:
+    _logger.warning(f'ITACA: no se ha podido leer la copia columnar {feather_file}: {str(e)}')
+    return None
+
+  return df, data_stack
+
+def _write_columnar(key, cache_dir: str, df, data_stack):
+  """
+  Guarda la copia columnar del fichero (con el data_stack en los metadatos) y elimina
+  las de versiones anteriores. Si el data_stack no se puede guardar como JSON sin
+  cambios no se guarda la copia
+  """
+  if feather is None:
+    return
+  
+  feather_file = _columnar_path(key, cache_dir)
+  prefix = os.path.basename(key[0]) + '.'
+
+  try:
+    stack_json = json.dumps(data_stack)
+    if json.loads(stack_json) != data_stack:
+      _logger.warning(f'ITACA: el data_stack no se puede guardar como JSON, no se guarda la copia columnar')
+      return
+
+    os.makedirs(cache_dir, exist_ok = True)
+
+    for filename in os.listdir(cache_dir):
+      if filename.startswith(prefix) and os.path.join(cache_dir, filename) != feather_file:
+        os.remove(os.path.join(cache_dir, filename))
+    
+    table = pyarrow.Table.from_pandas(df, preserve_index = True)
+    metadata = dict(table.schema.metadata or {})
+    metadata[DATA_STACK_METADATA_KEY] = stack_json.encode()
+    table = table.replace_schema_metadata(metadata)
+
+    # escribo en un temporal y renombro para que otro worker nunca lea ficheros a medias
+    feather.write_feather(table, feather_file + '.tmp')
+    os.replace(feather_file + '.tmp', feather_file)
+  except Exception as e:
+    _logger.warning(f'ITACA: no se ha podido guardar la copia columnar {feather_file}: {str(e)}')
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Grabación y reproducción de las respuestas de Moodle de la comprobación de asistencia.
+
+- RecordingMoodleSource envuelve al origen real (ver support.moodle_source) y guarda
+  los estudiantes de cada aula en <directorio>/classroom_<moodle_id>.json.gz. Sólo se
+  guardan los atributos de RECORDED_FIELDS y ANONYMIZED_FIELDS, estos últimos (NIA, 
+  emails, nombres...) sustituidos por un hash con sal. El mismo valor produce siempre
+  el mismo hash, por lo que un estudiante sigue siendo el mismo en todas las aulas.
+- ReplayMoodleSource sirve esos ficheros sin conexión, con una latencia (y variación)
+  configurable para simular la red. Sólo se utiliza si se pasa en el contexto:
+
+  >>> from odoo.addons.maya_students.support.moodle_fixtures import ReplayMoodleSource
+  >>> source = ReplayMoodleSource('/tmp/moodle_rec', latency = 0.2, jitter = 0.05, seed = 1)
+  >>> env['maya_students.cron_check_attendance_classroom'].with_context(
+  ...   moodle_source = source).cron_check_attendance_school_year(check_classrooms)
+
+Así se puede medir o perfilar el cron nocturno con datos con la forma de los de
+producción sin acceder a Moodle (en una base de datos desechable).
+"""
+
+from types import SimpleNamespace
+import threading
+import hashlib
+import logging
+import random
+import json
+import gzip
+import time
+import os
+
+_logger = logging.getLogger(__name__)
+
+# atributos de los usuarios de Moodle que se graban tal cual. Cualquier otro atributo
+# (teléfonos, direcciones, campos personalizados...) no se graba
+RECORDED_FIELDS = {'id', 'lastcourseaccess', 'lastaccess'}
+# atributos de identidad que se graban sustituidos por su hash
+ANONYMIZED_FIELDS = {'username', 'idnumber', 'email', 'firstname', 'lastname', 'fullname'}
+# atributos anonimizados que deben seguir pareciendo un NIA (sólo dígitos)
+NUMERIC_ANONYMIZED_FIELDS = {'username', 'idnumber'}
+
+FIXTURE_VERSION = 1
+
+def anonymize_value(value, salt: str, numeric: bool = False):
+  """
+  Sustituye un valor por su hash con sal. Los valores numéricos se convierten en
+  un número de 8 cifras y los emails conservan el formato
+
+  :numeric si True y el valor son sólo dígitos, el hash también
+  """
+  if value in (None, '', False):
+    return value
+
+  text = str(value)
+  digest = hashlib.sha256(f'{salt}:{text.strip().lower()}'.encode()).hexdigest()
+
+  if numeric and text.isdigit():
+    return str(int(digest, 16) % 10 ** 8).zfill(8)
+  if '@' in text:
+    return f'{digest[:16]}@anon.invalid'
+
+  return digest[:16]
+
+def anonymize_user(user, salt: str) -> dict:
+  """
+  Convierte un usuario de Moodle en un diccionario serializable sin datos personales.
+  Sólo se conservan los atributos de RECORDED_FIELDS y, anonimizados, los de 
+  ANONYMIZED_FIELDS
+  """
+  data = {}
+  for key in sorted(RECORDED_FIELDS | ANONYMIZED_FIELDS):
+    if not hasattr(user, key):
+      continue
+
+    value = getattr(user, key)
+    if key in ANONYMIZED_FIELDS:
+      value = anonymize_value(value, salt, numeric = key in NUMERIC_ANONYMIZED_FIELDS)
+
+    data[key] = value
+
+  return data
+
+def fixture_path(directory: str, moodle_id: int) -> str:
+  return os.path.join(directory, f'classroom_{moodle_id}.json.gz')
+
+class RecordingMoodleSource:
+  """
+  Origen que obtiene los estudiantes de otro origen y graba las respuestas anonimizadas
+
+  :source origen real (normalmente support.moodle_source.MoodleSource)
+  :directory directorio de las grabaciones
+  :salt sal de los hash. Hay que usar la misma en todas las grabaciones de un conjunto
+  """
+  def __init__(self, source, directory: str, salt: str):
+    self.source = source
+    self.directory = directory
+    self.salt = salt
+    os.makedirs(directory, exist_ok = True)
+
+  def connect(self):
+    return self.source.connect()
+
+  def course_students(self, conn, moodle_id: int) -> list:
+    users = self.source.course_students(conn, moodle_id)
+
+    try:
+      self._write(moodle_id, [anonymize_user(user, self.salt) for user in users])
+    except Exception as e:
+      # la grabación nunca debe hacer fallar la comprobación
+      _logger.error(f'Error grabando las respuestas de Moodle del aula {moodle_id}: {str(e)}')
+
+    return users
+
+  def _write(self, moodle_id: int, users: list):
+    path = fixture_path(self.directory, moodle_id)
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+
+    with gzip.open(tmp_path, 'wt', encoding = 'utf-8') as f:
+      json.dump({
+        'version': FIXTURE_VERSION,
+        'moodle_id': moodle_id,
+        'recorded': int(time.time()),
+        'users': users,
+      }, f)
+
+    os.replace(tmp_path, path)
+
+class ReplayMoodleSource:
+  """
+  Origen que sirve las respuestas grabadas con RecordingMoodleSource sin conexión
+
+  :directory directorio de las grabaciones
+  :latency segundos de espera de cada petición
+  :jitter variación máxima (+/-) de la espera en segundos
+  :seed semilla de la variación para que las ejecuciones sean reproducibles
+  """
+  def __init__(self, directory: str, latency: float = 0.0, jitter: float = 0.0, seed: int = None):
+    self.directory = directory
+    self.latency = latency
+    self.jitter = jitter
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  def connect(self):
+    return None
+
+  def course_students(self, conn, moodle_id: int) -> list:
+    if self.latency or self.jitter:
+      with self._lock:
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+      time.sleep(max(0.0, delay))
+
+    path = fixture_path(self.directory, moodle_id)
+    if not os.path.exists(path):
+      raise Exception(f'No hay grabación de Moodle para el aula {moodle_id} en {self.directory}')
+
+    with gzip.open(path, 'rt', encoding = 'utf-8') as f:
+      data = json.load(f)
+
+    return [SimpleNamespace(**user) for user in data['users']]
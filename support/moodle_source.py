@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+Origen de los estudiantes de las aulas de Moodle para la comprobación de asistencia.
+
+Por defecto se consulta el Moodle configurado. Se puede sustituir pasando otro 
+origen en la clave 'moodle_source' del contexto (por ejemplo, un Moodle simulado 
+para medir el rendimiento del cron sin acceder a la red). Cualquier objeto con los
+métodos connect y course_students sirve como origen.
+
+También se pueden grabar las respuestas del Moodle real (ver get_moodle_source) y
+reproducirlas sin conexión pasando en el contexto un ReplayMoodleSource (ver
+support.moodle_fixtures). La reproducción nunca se activa con un parámetro: en una
+base de datos real el cron compararía las matrículas con datos que no son los
+actuales y borraría anulaciones válidas.
+"""
+
+import uuid
+
+from ...maya_core.support.maya_moodleteacher.maya_moodle_connection import MayaMoodleConnection
+from ...maya_core.support.maya_moodleteacher.maya_moodle_user import MayaMoodleUsers
+
+from .moodle_fixtures import RecordingMoodleSource
+
+# clave del contexto con la que se sustituye el origen
+MOODLE_SOURCE_CONTEXT_KEY = 'moodle_source'
+
+class MoodleSource:
+  """
+  Estudiantes obtenidos del Moodle configurado
+  """
+  def __init__(self, moodle_user: str, moodle_host: str):
+    self.moodle_user = moodle_user
+    self.moodle_host = moodle_host
+
+  def connect(self):
+    """
+    Crea una conexión. Se llama una vez por hilo de descarga
+    """
+    return MayaMoodleConnection(user = self.moodle_user, moodle_host = self.moodle_host)
+
+  def course_students(self, conn, moodle_id: int) -> list:
+    """
+    Devuelve los estudiantes del aula moodle_id
+    """
+    return MayaMoodleUsers.from_course(conn, moodle_id, only_students = True)
+
+def get_moodle_source(env) -> MoodleSource:
+  """
+  Devuelve el origen indicado en el contexto o, si no hay ninguno, el Moodle configurado.
+  Si está definido 'maya_students.moodle_record_dir' se graban en ese directorio sus
+  respuestas anonimizadas (ver support.moodle_fixtures)
+  """
+  source = env.context.get(MOODLE_SOURCE_CONTEXT_KEY)
+  if source is not None:
+    return source
+
+  params = env['ir.config_parameter'].sudo()
+
+  source = MoodleSource(
+    params.get_param('maya_core.moodle_user_admin'),
+    params.get_param('maya_core.moodle_url'))
+
+  record_dir = params.get_param('maya_students.moodle_record_dir')
+  if record_dir:
+    # la sal se genera la primera vez y se conserva para que todas las grabaciones 
+    # anonimicen igual a cada estudiante
+    salt = params.get_param('maya_students.moodle_record_salt')
+    if not salt:
+      salt = uuid.uuid4().hex
+      params.set_param('maya_students.moodle_record_salt', salt)
+
+    source = RecordingMoodleSource(source, record_dir, salt)
+
+  return source
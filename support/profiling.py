@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+Perfilado (cProfile) bajo demanda de los procesos pesados del módulo.
+
+Los métodos decorados con @profiled sólo se perfilan si está activo el parámetro
+'maya_students.profile' ('1'/'true' para todos, o la lista separada por comas de
+los nombres de los métodos a perfilar) o la clave 'maya_profile' del contexto.
+Si no, el único coste es la lectura (cacheada) del parámetro.
+
+El perfil (.prof, para snakeviz o pstats) y un resumen con las N funciones más
+costosas se guardan como adjuntos. Si durante la ejecución se indica un registro
+con set_profile_target (p.e. la ejecución de la comprobación de asistencia), los
+adjuntos se asocian a él.
+"""
+
+from datetime import datetime
+import cProfile
+import functools
+import threading
+import logging
+import marshal
+import pstats
+import base64
+import time
+import io
+
+from odoo import api
+
+_logger = logging.getLogger(__name__)
+
+PROFILE_PARAM = 'maya_students.profile'
+PROFILE_TOP_PARAM = 'maya_students.profile_top'
+PROFILE_CONTEXT_KEY = 'maya_profile'
+
+# nº de funciones del resumen por defecto
+DEFAULT_PROFILE_TOP = 30
+
+# sesión de perfilado activa en el hilo (no se anidan: el perfil exterior ya
+# incluye a los métodos perfilados que se llamen desde él)
+_local = threading.local()
+
+def is_profiling_enabled(env, name: str) -> bool:
+  """
+  Indica si hay que perfilar el método name
+  """
+  if env.context.get(PROFILE_CONTEXT_KEY):
+    return True
+
+  value = (env['ir.config_parameter'].sudo().get_param(PROFILE_PARAM) or '').strip().lower()
+  if value in ('', '0', 'false'):
+    return False
+
+  return value in ('1', 'true') or name.lower() in [v.strip() for v in value.split(',')]
+
+def set_profile_target(record):
+  """
+  Asocia los adjuntos del perfil en curso (si lo hay) al registro indicado
+  """
+  session = getattr(_local, 'session', None)
+  if session is not None:
+    session['target'] = (record._name, record.id)
+
+def profiled(name: str = None):
+  """
+  Decorador de métodos de modelos que los perfila si está activado (ver la
+  documentación del módulo)
+
+  :name nombre con el que se activa y se guarda el perfil. Por defecto el del método
+  """
+  def decorator(method):
+    label = name or method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+      if getattr(_local, 'session', None) is not None or not is_profiling_enabled(self.env, label):
+        return method(self, *args, **kwargs)
+
+      _local.session = session = {'target': None}
+      profiler = cProfile.Profile()
+      sql_start = self.env.cr.sql_log_count
+      start = time.perf_counter()
+
+      profiler.enable()
+      try:
+        return method(self, *args, **kwargs)
+      finally:
+        profiler.disable()
+        _local.session = None
+        try:
+          _save_profile(self.env, label, profiler, session['target'] or (self._name, False),
+                        time.perf_counter() - start, self.env.cr.sql_log_count - sql_start)
+        except Exception as e:
+          _logger.error(f'Error guardando el perfil de {label}: {str(e)}')
+
+    return wrapper
+  return decorator
+
+def _save_profile(env, label: str, profiler: cProfile.Profile, target: tuple, elapsed: float, sql_count: int):
+  """
+  Guarda el perfil y su resumen como adjuntos del registro target (modelo, id).
+  Se utiliza otro cursor para que se guarden aunque el proceso perfilado falle
+  y su transacción se deshaga
+  """
+  with env.registry.cursor() as cr:
+    new_env = api.Environment(cr, env.uid, env.context)
+    top = int(new_env['ir.config_parameter'].sudo().get_param(PROFILE_TOP_PARAM, DEFAULT_PROFILE_TOP))
+
+    summary = io.StringIO()
+    summary.write(f'{label}: {elapsed:.3f} s, {sql_count} consultas SQL\n\n')
+    stats = pstats.Stats(profiler, stream = summary)
+    stats.sort_stats('cumulative').print_stats(top)
+    stats.sort_stats('tottime').print_stats(top)
+
+    # mismo formato que pstats.Stats.dump_stats
+    profile_data = marshal.dumps(stats.stats)
+
+    filename = f"profile_{label}_{datetime.now().strftime('%y%m%d%H%M%S')}"
+    res_model, res_id = target
+
+    new_env['ir.attachment'].sudo().create([{
+      'name': f'{filename}.prof',
+      'res_model': res_model,
+      'res_id': res_id,
+      'mimetype': 'application/octet-stream',
+      'datas': base64.b64encode(profile_data),
+    }, {
+      'name': f'{filename}.txt',
+      'res_model': res_model,
+      'res_id': res_id,
+      'mimetype': 'text/plain',
+      'datas': base64.b64encode(summary.getvalue().encode()),
+    }])
+
+  _logger.info(f'Perfil de {label} guardado en {filename} ({res_model},{res_id})')
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+from . import test_cron_check_attendance
+from . import test_notification_job
+from . import test_moodle_fixtures
+from . import test_benchmark
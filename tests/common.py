@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from types import SimpleNamespace
+import uuid
+
+from odoo.tests import TransactionCase
+
+from ...maya_core.models.cron_register_jobs.cron_job_enrol_users import CronJobEnrolUsers
+
+# rangos de identificadores de los datos de prueba
+BASE_NIA = 80000000
+BASE_MOODLE_USER_ID = 8000000
+MOODLE_CLASSROOM_ID = 800000
+
+class MayaStudentsCase(TransactionCase):
+  """
+  Datos comunes de las pruebas: un ciclo, un módulo (con su aula de Moodle) y
+  utilidades para crear usuarios de Moodle y estudiantes
+  """
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls.tag = uuid.uuid4().hex[:6].upper()
+
+    cls.course = cls.env['maya_core.course'].create({
+      'name': f'Pruebas {cls.tag}',
+      'code': f'TST{cls.tag}',
+      'abbr': 'TST',
+    })
+    cls.subject = cls.env['maya_core.subject'].create({
+      'name': f'Pruebas {cls.tag} módulo',
+      'code': f'TST{cls.tag}',
+    })
+    cls.classroom = (MOODLE_CLASSROOM_ID, cls.subject.id)
+    cls.cron = cls.env['maya_students.cron_check_attendance_classroom']
+
+  def moodle_user(self, n: int, **values):
+    """
+    Usuario de Moodle de prueba (mismos atributos que los de support.moodle_source)
+    """
+    nia = str(BASE_NIA + n)
+    return SimpleNamespace(**dict({
+      'id': BASE_MOODLE_USER_ID + n,
+      'username': nia,
+      'idnumber': nia,
+      'firstname': f'Estudiante {n}',
+      'lastname': f'Pruebas {self.tag}',
+      'fullname': f'Estudiante {n} Pruebas {self.tag}',
+      'email': f'tst{self.tag.lower()}.{n}@test.invalid',
+      'lastcourseaccess': 0,
+      'lastaccess': 0,
+    }, **values))
+
+  def student(self, n: int):
+    """
+    Crea el estudiante de un usuario de Moodle de prueba igual que lo hace el cron
+    """
+    return CronJobEnrolUsers.enrol_student(self.cron, self.moodle_user(n), self.subject.id, self.course.id,
+                                           only_create = True)
+
+  def enrol(self, student):
+    """
+    Matricula al estudiante en el módulo y el ciclo de prueba
+    """
+    return self.env['maya_core.subject_student_rel'].create({
+      'subject_id': self.subject.id,
+      'course_id': self.course.id,
+      'student_id': student.id,
+    })
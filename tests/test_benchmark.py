@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+import tempfile
+import os
+
+from odoo.tests import TransactionCase, tagged
+
+from ..models.cron_register_jobs import cron_check_attendance_classroom as cron_module
+from ..support.benchmark import run_benchmark
+
+@tagged('post_install', '-at_install', '-standard', 'benchmark')
+class TestBenchmark(TransactionCase):
+  """
+  Banco de pruebas de rendimiento (ver support.benchmark). No se ejecuta con el resto
+  de pruebas: sólo con --test-tags benchmark. Los commit del cron no se hacen, por lo
+  que los datos sintéticos se descartan al terminar
+  """
+  def test_benchmark(self):
+    self.env['ir.config_parameter'].sudo().set_param('maya_students.benchmark_enabled', 'True')
+
+    with tempfile.TemporaryDirectory() as itaca_dir, \
+         patch.object(cron_module, 'ITACA_DIR', itaca_dir + os.sep), \
+         patch.object(type(self.env['ir.mail_server']), '_is_test_mode', return_value = False), \
+         patch.object(self.env.cr, 'commit'):
+      results = run_benchmark(self.env, cycles = 2, classrooms = 6, students = 15,
+                              baseline = os.environ.get('MAYA_BENCHMARK_BASELINE'))
+
+    counts = results['counts']
+    # cada aula se descarga de Moodle una sola vez aunque la compartan varios ciclos
+    self.assertEqual(counts['moodle_requests'], counts['classrooms'])
+    # por ciclo, cada aula se descarga una vez por cada ciclo que la comparte
+    self.assertEqual(counts['moodle_requests_classroom'], counts['check_classrooms'])
+    # si los datos sintéticos no producen anulaciones el banco de pruebas no mide nada
+    self.assertGreater(counts['cancellations'], 0)
+    self.assertGreaterEqual(counts['mails_received'], 1)
+    self.assertEqual(set(results['phases']), {'generate', 'attendance', 'attendance_classroom', 'notifications'})
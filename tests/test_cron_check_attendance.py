@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from odoo.exceptions import ValidationError
+from odoo.tests import tagged
+
+from .common import MayaStudentsCase
+
+@tagged('post_install', '-at_install')
+class TestCronCheckAttendanceFailures(MayaStudentsCase):
+  """
+  El error de un estudiante no debe impedir procesar al resto del aula
+  """
+  def test_enrol_itaca_failure_is_isolated(self):
+    """
+    Si la sincronización con ITACA falla tras crear el estudiante, se deshace sólo ese
+    estudiante y el mensaje de error no lee el registro ya inexistente
+    """
+    users = [self.moodle_user(1), self.moodle_user(2), self.moodle_user(3)]
+    calls = []
+
+    def update_from_itaca(maya_user, itaca_index, data_stack, course_dict):
+      calls.append(maya_user.id)
+      if len(calls) == 2:
+        raise ValidationError('Fallo inyectado en ITACA')
+
+    with patch.object(type(self.cron), '_update_student_from_itaca', side_effect = update_from_itaca):
+      _, errors, failed_users = self.cron._enrol_students_batch(
+        users, self.classroom, self.course.id, None, [], {})
+
+    self.assertEqual(len(calls), 3, 'Se deben procesar todos los usuarios')
+    self.assertEqual(list(failed_users), [users[1].id])
+    self.assertEqual(len(errors), 1)
+    self.assertIn('Fallo inyectado en ITACA', errors[0])
+
+    # el estudiante creado para el usuario que ha fallado se ha deshecho
+    failed_student = self.env['maya_core.student'].browse(failed_users[users[1].id])
+    self.assertFalse(failed_student.exists())
+    self.assertTrue(self.env['maya_core.student'].browse(calls[0]).exists())
+    self.assertTrue(self.env['maya_core.student'].browse(calls[2]).exists())
+
+  def test_memo_by_nia_only_reused_for_the_same_student(self):
+    """
+    Una entrada de la memoria con el mismo NIA pero de otro estudiante no se reutiliza:
+    el estudiante se sincroniza y guarda su propia entrada
+    """
+    student = self.student(1)
+    other_student = self.student(2)
+
+    students_memo = self.cron._new_students_memo()
+    students_memo['by_nia'][student.nia] = {
+      'student_id': other_student.id, 'nia': student.nia, 'course_ids': {self.course.id} }
+
+    with patch.object(type(self.cron), '_update_student_from_itaca') as update_from_itaca:
+      students_by_moodle_id, errors, _ = self.cron._enrol_students_batch(
+        [self.moodle_user(1)], self.classroom, self.course.id, None, [], {}, students_memo)
+
+    self.assertFalse(errors)
+    self.assertEqual(update_from_itaca.call_args[0][0], student)
+    self.assertEqual([entry['student_id'] for _, entry in students_memo['pending']], [student.id])
+    self.assertNotIn(other_student, students_by_moodle_id.values())
+
+  def test_reconcile_create_failure_is_retried_row_by_row(self):
+    """
+    Si el create de todas las anulaciones falla, se reintenta de una en una y sólo se
+    pierde la del estudiante que falla, que se devuelve como no procesado
+    """
+    students = [self.student(n) for n in (1, 2, 3)]
+    rels = [self.enrol(student) for student in students]
+    failing_rel = rels[1]
+    access = datetime(2000, 1, 1)
+
+    Cancellation = self.env['maya_students.cancellation']
+    original_create = type(Cancellation).create
+
+    def create(records, vals_list):
+      vals_list = vals_list if isinstance(vals_list, list) else [vals_list]
+      if any(vals.get('subject_student_rel_id') == failing_rel.id for vals in vals_list):
+        raise ValidationError('Fallo inyectado en la anulación')
+      return original_create(records, vals_list)
+
+    stats = {}
+    with patch.object(type(Cancellation), 'create', create):
+      cancellation_by_student, errors, skipped_student_ids = self.cron._reconcile_cancellations(
+        [(student, access) for student in students], self.classroom, self.course.id, stats = stats)
+
+    self.assertEqual(set(cancellation_by_student), {students[0].id, students[2].id})
+    self.assertEqual(skipped_student_ids, {students[1].id})
+    self.assertEqual(len(errors), 1)
+    self.assertEqual(stats['created_count'], 2)
+
+    created = Cancellation.search([('subject_student_rel_id', 'in', [rel.id for rel in rels])])
+    self.assertEqual(set(created.mapped('subject_student_rel_id').ids), {rels[0].id, rels[2].id})
+
+  def test_reconcile_updates_existing_cancellations(self):
+    """
+    Las anulaciones existentes reciben la fecha de último acceso y los códigos de error 
+    de cada estudiante
+    """
+    students = [self.student(n) for n in (1, 2)]
+    rels = [self.enrol(student) for student in students]
+    Cancellation = self.env['maya_students.cancellation']
+    cancellations = Cancellation.create([{
+      'subject_student_rel_id': rel.id,
+      'cancellation_type': 'OFC',
+      'situation': '1',
+      'lastaccess_date': datetime(2000, 1, 1),
+    } for rel in rels])
+
+    accesses = [datetime(2024, 1, 1, 10), datetime(2024, 2, 1, 10)]
+    stats = {}
+    cancellation_by_student, errors, _ = self.cron._reconcile_cancellations(
+      list(zip(students, accesses)), self.classroom, self.course.id, stats = stats)
+
+    self.assertFalse(errors)
+    self.assertEqual(stats['updated_count'], 2)
+    self.assertEqual(set(cancellation_by_student.values()), set(cancellations.ids))
+    self.assertEqual(cancellations.mapped('lastaccess_date'), accesses)
+    self.assertEqual(set(cancellations.mapped('classroom_moodle_id')), {self.classroom[0]})
+
+  def test_classroom_with_failure_rate(self):
+    """
+    Con uno de cada tres estudiantes fallando, el resto del aula se procesa, las
+    anulaciones de los que fallan no se borran y los errores quedan registrados
+    """
+    users = [self.moodle_user(n) for n in range(9)]
+    failing_ids = { user.id for n, user in enumerate(users) if n % 3 == 2 }
+    # un estudiante que sí se ha conectado: su anulación es obsoleta y se borra
+    connected_user = self.moodle_user(9, lastcourseaccess = int(datetime.now().timestamp()))
+
+    students = { user.id: self.student(n) for n, user in enumerate(users + [connected_user]) }
+    Cancellation = self.env['maya_students.cancellation']
+    cancellations = { moodle_user_id: Cancellation.create({
+      'subject_student_rel_id': self.enrol(student).id,
+      'cancellation_type': 'OFC',
+      'situation': '1',
+    }) for moodle_user_id, student in students.items() }
+
+    # los que no fallan ya están resueltos (ciclos incluidos) por un aula anterior de la ejecución
+    students_memo = self.cron._new_students_memo()
+    for moodle_user_id, student in students.items():
+      if moodle_user_id not in failing_ids:
+        students_memo['by_moodle_id'][moodle_user_id] = {
+          'student_id': student.id, 'nia': student.nia, 'course_ids': {self.course.id} }
+
+    failing_student_ids = { students[moodle_user_id].id for moodle_user_id in failing_ids }
+
+    def update_from_itaca(maya_user, itaca_index, data_stack, course_dict):
+      if maya_user.id in failing_student_ids:
+        raise ValidationError('Fallo inyectado en ITACA')
+
+    run = {
+      'attendance_run': self.env['maya_students.attendance_run']._start('Pruebas'),
+      'stats': {},
+      'fetch_times': {},
+      'deadline': datetime.now() - timedelta(days = 8),
+      'itaca': (None, [], {}),
+      'incremental': False,
+      'commit_size': 100,
+      'students_memo': students_memo,
+    }
+    errors = []
+
+    with patch.object(type(self.cron), '_update_student_from_itaca', side_effect = update_from_itaca), \
+         patch.object(self.env.cr, 'commit'):
+      self.cron._check_course_classrooms([self.classroom], self.course.id,
+        {self.classroom[0]: users + [connected_user]}, run, errors)
+
+    self.assertEqual(len(errors), len(failing_ids))
+    self.assertEqual(len(run['attendance_run'].error_ids), len(failing_ids))
+
+    for user in users:
+      cancellation = cancellations[user.id]
+      self.assertTrue(cancellation.exists(), f'La anulación del usuario {user.id} no se debe borrar')
+      if user.id not in failing_ids:
+        self.assertEqual(cancellation.classroom_moodle_id, self.classroom[0])
+        self.assertTrue(cancellation.query_date)
+
+    self.assertFalse(cancellations[connected_user.id].exists())
+    self.assertEqual(run['stats']['deleted_count'], 1)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import tempfile
+
+from odoo.tests import tagged
+
+from ..support.moodle_fixtures import RecordingMoodleSource, ReplayMoodleSource, anonymize_user
+from ..support.moodle_source import MOODLE_SOURCE_CONTEXT_KEY, get_moodle_source
+from ..support.benchmark import FakeMoodleSource
+from .common import MayaStudentsCase
+
+SALT = 'pruebas'
+
+@tagged('post_install', '-at_install')
+class TestMoodleFixtures(MayaStudentsCase):
+  """
+  Grabación anonimizada y reproducción de las respuestas de Moodle
+  """
+  def test_only_allowed_fields_are_recorded(self):
+    user = self.moodle_user(1, lastcourseaccess = 1700000000, phone1 = '600000000',
+                            address = 'Calle Mayor 1', customfields = [{'value': 'x'}])
+
+    data = anonymize_user(user, SALT)
+
+    self.assertEqual(set(data), {'id', 'lastcourseaccess', 'lastaccess', 'username', 'idnumber',
+                                 'email', 'firstname', 'lastname', 'fullname'})
+    self.assertEqual(data['id'], user.id)
+    self.assertEqual(data['lastcourseaccess'], user.lastcourseaccess)
+    for key in ('username', 'idnumber', 'email', 'firstname', 'lastname', 'fullname'):
+      self.assertNotEqual(data[key], getattr(user, key))
+
+    # el mismo estudiante se anonimiza igual en todas las aulas
+    self.assertEqual(anonymize_user(self.moodle_user(1), SALT)['username'], data['username'])
+    self.assertTrue(data['username'].isdigit())
+
+  def test_record_and_replay(self):
+    users = [self.moodle_user(1), self.moodle_user(2)]
+
+    with tempfile.TemporaryDirectory() as directory:
+      recorder = RecordingMoodleSource(FakeMoodleSource({self.classroom[0]: users}), directory, SALT)
+      self.assertEqual(recorder.course_students(None, self.classroom[0]), users)
+
+      replayed = ReplayMoodleSource(directory).course_students(None, self.classroom[0])
+
+    self.assertEqual([user.id for user in replayed], [user.id for user in users])
+    self.assertEqual([user.username for user in replayed],
+                     [anonymize_user(user, SALT)['username'] for user in users])
+
+  def test_replay_only_from_context(self):
+    params = self.env['ir.config_parameter'].sudo()
+    params.set_param('maya_students.moodle_replay_dir', '/tmp')
+    params.set_param('maya_students.moodle_record_dir', False)
+
+    self.assertNotIsInstance(get_moodle_source(self.env), ReplayMoodleSource)
+
+    source = ReplayMoodleSource('/tmp')
+    self.assertIs(get_moodle_source(self.env(context = {MOODLE_SOURCE_CONTEXT_KEY: source})), source)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.exceptions import AccessError
+from odoo.tests import tagged, new_test_user
+
+from .common import MayaStudentsCase
+from ..models import cancellation as cancellation_module
+from ..support.benchmark import SmtpSink
+
+@tagged('post_install', '-at_install')
+class TestNotificationJob(MayaStudentsCase):
+  """
+  Envío en segundo plano de las notificaciones agrupadas contra un servidor SMTP local
+  """
+  def setUp(self):
+    super().setUp()
+    self.Job = self.env['maya_students.notification_job']
+    students = [self.student(n) for n in (1, 2)]
+    for n, student in enumerate(students):
+      student.write({'email': f'tst{self.tag.lower()}.mail{n}@test.invalid'})
+
+    # anulaciones ya reservadas por la acción de envío agrupado
+    self.cancellations = self.env['maya_students.cancellation'].create([{
+      'subject_student_rel_id': self.enrol(student).id,
+      'cancellation_type': 'OFC',
+      'situation': '2',
+    } for student in students])
+    self.packages = [{'main_id': c.id, 'related_ids': []} for c in self.cancellations]
+
+  def process_jobs(self, port: int):
+    """
+    Ejecuta el cron de envío con el servidor de correo del centro apuntando al puerto
+    indicado de 127.0.0.1. Los commit del cron no se hacen para no romper la transacción
+    de la prueba
+    """
+    mail_server = self.env['ir.mail_server'].create({
+      'name': f'Pruebas {self.tag}',
+      'smtp_host': '127.0.0.1',
+      'smtp_port': port,
+      'smtp_encryption': 'none',
+    })
+    with patch.object(cancellation_module, 'get_mail_server', return_value = mail_server), \
+         patch.object(type(self.env['ir.mail_server']), '_is_test_mode', return_value = False), \
+         patch.object(self.env.cr, 'commit'):
+      self.Job.cron_process_notification_jobs()
+
+  def test_jobs_are_sent(self):
+    jobs = self.Job._enqueue(self.packages)
+
+    with SmtpSink() as sink:
+      self.process_jobs(sink.port)
+
+    self.assertGreaterEqual(sink.messages, len(self.packages))
+    self.assertEqual(set(jobs.mapped('state')), {'done'})
+    self.assertEqual(sum(jobs.mapped('sent')), len(self.packages))
+    self.assertEqual(set(self.cancellations.mapped('situation')), {'3'})
+
+  def test_send_failure_is_retried(self):
+    jobs = self.Job._enqueue(self.packages)
+    mail_count = self.env['mail.mail'].search_count([])
+
+    # puerto de un servidor ya cerrado: la conexión SMTP falla
+    with SmtpSink() as sink:
+      port = sink.port
+    self.process_jobs(port)
+
+    self.assertEqual(set(jobs.mapped('state')), {'queued'})
+    self.assertEqual(jobs.mapped('attempts'), [1] * len(jobs))
+    self.assertGreater(min(jobs.mapped('next_attempt')), fields.Datetime.now())
+    self.assertEqual(set(self.cancellations.mapped('situation')), {'2'})
+    # los mails fallidos no se quedan en la cola: el reintento crea otros
+    self.assertEqual(self.env['mail.mail'].search_count([]), mail_count)
+
+  def test_stale_running_job_is_requeued(self):
+    job = self.Job._enqueue(self.packages)
+    job.sudo().write({'state': 'running'})
+    # la anulación del primer paquete ya se notificó antes de la interrupción
+    self.cancellations[0]._transition_situation('2', '3')
+
+    job.flush_recordset()
+    self.env.cr.execute(f'UPDATE "{self.Job._table}" SET write_date = %s WHERE id = %s',
+                        [fields.Datetime.now() - timedelta(hours = 2), job.id])
+    job.invalidate_recordset()
+
+    self.assertEqual(self.Job._requeue_stale_jobs(), job)
+    self.assertEqual(job.state, 'queued')
+    self.assertEqual(job.attempts, 1)
+    self.assertEqual(job.packages, self.packages[1:])
+
+  def test_users_only_read_jobs(self):
+    user = new_test_user(self.env, login = f'tst{self.tag.lower()}', groups = 'base.group_user')
+
+    jobs = self.Job.with_user(user)._enqueue(self.packages)
+    self.assertEqual(jobs.user_id, user)
+    self.assertTrue(jobs.read(['state']))
+
+    with self.assertRaises(AccessError):
+      jobs.write({'state': 'done'})